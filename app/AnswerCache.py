@@ -0,0 +1,123 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from logger_config import configure_logger
+
+# Answering again questions similar to ones already answered, instead of retrieving and generating
+USE_ANSWER_CACHE = os.getenv('USE_ANSWER_CACHE', 'true').lower() == 'true'
+# Cosine similarity between question embeddings above which a cached answer is used
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95))
+# Most answers kept, the least recently used are evicted first
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 1000))
+# Seconds an answer is kept
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 24 * 60 * 60))
+
+class CachedAnswer():
+
+    def __init__(self, vector, settings, versions, answer, references):
+
+        self.vector = vector # normalized question embedding
+        self.settings = settings # collections and LLM settings the answer was generated with
+        self.versions = versions # { collection : version } when the answer was generated
+        self.answer = answer
+        self.references = references
+        self.created = time.time()
+
+class AnswerCache():
+
+    """
+    Answers keyed by the embedding of their question. A question reuses an answer when its embedding is similar enough,
+    it was asked with the same settings and the collections didn't change since (same versions). LRU with TTL.
+    """
+
+    def __init__(self, similarity=ANSWER_CACHE_SIMILARITY, size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL):
+
+        self.logger = configure_logger('AC', 'debug', 'logs')
+
+        self.similarity = similarity
+        self.size = size
+        self.ttl = ttl
+
+        self.entries = OrderedDict() # id : CachedAnswer, from the least to the most recently used
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @property
+    def metrics(self):
+        return {'entries' : len(self.entries), 'hits' : self.hits, 'misses' : self.misses, 'hit_rate' : self.hit_rate, 'evictions' : self.evictions, 'expirations' : self.expirations}
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def remove_expired(self):
+
+        now = time.time()
+
+        for id in [id for id, entry in self.entries.items() if now - entry.created > self.ttl]:
+            del self.entries[id]
+            self.expirations += 1
+
+    def lookup(self, embedding, settings, versions):
+
+        """
+        Returns the CachedAnswer of the most similar question asked with the same settings and collection versions, or None
+        """
+
+        vector = self.normalize(embedding)
+
+        with self.lock:
+
+            self.remove_expired()
+
+            candidates = [(id, entry) for id, entry in self.entries.items() if entry.settings == settings and entry.versions == versions]
+
+            best = None
+
+            if candidates:
+                similarities = np.stack([entry.vector for _, entry in candidates]) @ vector
+                position = int(np.argmax(similarities))
+
+                if similarities[position] >= self.similarity:
+                    best = candidates[position]
+
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(best[0])
+
+            self.logger.debug(f"Answer cache {'hit' if best else 'miss'}: {self.metrics}")
+
+        return best[1] if best else None
+
+    def store(self, embedding, settings, versions, answer, references=None):
+
+        with self.lock:
+
+            self.entries[self.next_id] = CachedAnswer(self.normalize(embedding), settings, versions, answer, references)
+            self.next_id += 1
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+## Process-wide cache, shared by every LLM object and Streamlit session
+answer_cache = AnswerCache()
+
+def get_answer_cache():
+    return answer_cache
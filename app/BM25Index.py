@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import unicodedata
+from collections import Counter
+from pathlib import Path # easy directory path creation
+
+import numpy as np
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+META_FILE = 'meta.json'
+IDS_FILE = 'ids.json'
+VOCABULARY_FILE = 'vocabulary.json'
+ARRAY_FILES = ('offsets', 'postings', 'frequencies', 'idf', 'norms')
+MAPPED_ARRAYS = ('postings', 'frequencies')
+
+# Lowercase words without accents, so "Matemática" and "matematica" are the same term
+def tokenize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r'\w+', text)
+
+class BM25Index():
+
+    """
+    Inverted index of the documents of a collection, for lexical search with BM25.
+    Postings are kept in compact arrays: the postings of term t are postings[offsets[t]:offsets[t+1]],
+    with the frequency of the term in each of those documents in frequencies.
+    """
+
+    def __init__(self, ids, vocabulary, offsets, postings, frequencies, idf, norms):
+
+        self.ids = ids
+        self.vocabulary = vocabulary # term : term id
+        self.offsets = offsets
+        self.postings = postings # document positions
+        self.frequencies = frequencies
+        self.idf = idf # per term
+        self.norms = norms # per document, K1 * (1 - B + B * length / average length)
+
+    @classmethod
+    def build(cls, ids, documents):
+
+        vocabulary = {}
+        term_documents = [] # documents of each term id
+        term_frequencies = []
+        lengths = np.zeros(len(ids), dtype=np.float32)
+
+        for position, document in enumerate(documents):
+
+            terms = Counter(tokenize(document or ''))
+            lengths[position] = sum(terms.values())
+
+            for term, frequency in terms.items():
+
+                if term not in vocabulary:
+                    vocabulary[term] = len(vocabulary)
+                    term_documents.append([])
+                    term_frequencies.append([])
+
+                term_documents[vocabulary[term]].append(position)
+                term_frequencies[vocabulary[term]].append(frequency)
+
+        document_frequency = np.array([len(positions) for positions in term_documents], dtype=np.int64)
+
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequency, out=offsets[1:])
+
+        postings = np.fromiter((position for positions in term_documents for position in positions), dtype=np.int32, count=offsets[-1])
+        frequencies = np.fromiter((frequency for term in term_frequencies for frequency in term), dtype=np.float32, count=offsets[-1])
+
+        idf = np.log(1 + (len(ids) - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+        average_length = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1
+        norms = (K1 * (1 - B + B * lengths / average_length)).astype(np.float32)
+
+        return cls(list(ids), vocabulary, offsets, postings, frequencies, idf, norms)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, k):
+
+        """
+        Returns the ids and BM25 scores of the k best documents for the query, best first
+        """
+
+        term_ids = {self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}
+
+        if not term_ids:
+            return [], []
+
+        documents, contributions = [], []
+
+        # Only the postings of the query terms are read, documents without any of the terms are never scored
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+
+            positions = self.postings[start:end]
+            frequencies = self.frequencies[start:end]
+
+            documents.append(positions)
+            contributions.append(self.idf[term_id] * frequencies * (K1 + 1) / (frequencies + self.norms[positions]))
+
+        candidates, inverse = np.unique(np.concatenate(documents), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+
+        k = min(k, len(candidates))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+
+        return [self.ids[candidates[i]] for i in best], scores[best].tolist()
+
+    def save(self, directory):
+
+        # if path to file doesn't exist, create it and its parents
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+        # Removing meta.json first, so an index being rewritten is never loaded
+        if os.path.exists(os.path.join(directory, META_FILE)):
+            os.remove(os.path.join(directory, META_FILE))
+
+        for name in ARRAY_FILES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+        with open(os.path.join(directory, IDS_FILE), 'w', encoding='utf8') as f:
+            json.dump(self.ids, f)
+
+        with open(os.path.join(directory, VOCABULARY_FILE), 'w', encoding='utf8') as f:
+            json.dump(self.vocabulary, f, ensure_ascii=False)
+
+        with open(os.path.join(directory, META_FILE), 'w', encoding='utf8') as f:
+            json.dump({'documents' : len(self.ids), 'terms' : len(self.vocabulary), 'postings' : int(self.offsets[-1])}, f)
+
+    @classmethod
+    def load(cls, directory):
+
+        if not os.path.exists(os.path.join(directory, META_FILE)):
+            return None
+
+        with open(os.path.join(directory, IDS_FILE), 'r', encoding='utf8') as f:
+            ids = json.load(f)
+
+        with open(os.path.join(directory, VOCABULARY_FILE), 'r', encoding='utf8') as f:
+            vocabulary = json.load(f)
+
+        # Postings are memory-mapped, only the postings of the terms searched are read from disk
+        arrays = {name : np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if name in MAPPED_ARRAYS else None) for name in ARRAY_FILES}
+
+        return cls(ids, vocabulary, **arrays)
@@ -13,7 +13,10 @@ from exceptions import BaseError
 
 from WebCrawler import WebCrawler
 from PageScraper import PageScraper
-from LLM import LLM
+from LLM import LLM, TOKEN_EVENT, RESET_EVENT, QUEUE_EVENT, ANSWER_EVENT
+from GenerationScheduler import SchedulerError
+from DB import MODEL_NAME
+from EmbeddingService import get_embedding_service
 from chroma_viewer import run as cv_run
 
 USERNAME = os.getenv('USERNAME')
@@ -211,7 +214,8 @@ def handle_progress_bar(crawling_progress, max_depth):
                 return pages
 
 # FOR PAGESCRAPER
-MAX_PHRASES = 10
+CHUNK_TOKENS = 0 # 0 uses the most tokens the embedding model reads without truncating
+CHUNK_OVERLAP = 16
 
 def scraper_page():
 
@@ -247,10 +251,12 @@ def scraper_page():
     # Updating session state to context inputted
     st.session_state.context = context
 
-    max_depth, max_phrases, html_cleanup = handle_scraper_adv_set(html_cleanup)
+    collect_garbage = st.checkbox("Remover do contexto o conteúdo que não está mais nas páginas", value=False)
+
+    max_depth, chunk_tokens, chunk_overlap, html_cleanup = handle_scraper_adv_set(html_cleanup)
 
     if scraper_button_clicked:
-        handle_scraping(data_dir, data_directories, max_depth, html_cleanup, max_phrases, st.session_state.context)
+        handle_scraping(data_dir, data_directories, max_depth, html_cleanup, chunk_tokens, chunk_overlap, st.session_state.context, collect_garbage)
 
 def handle_scraper_session_state():
     # Checking if context is in session_state for ease of use
@@ -285,7 +291,8 @@ def handle_scraper_adv_set(html_cleanup):
     if st.session_state.scraper_adv_conf_button:
 
         max_depth = int(st.text_input("Escolha a profundidade máxima:", MAX_DEPTH))
-        max_phrases = int(st.text_input("Escolha em quantas frases devem ser separadas as entradas no banco de dados:", MAX_PHRASES))
+        chunk_tokens = int(st.text_input("Escolha o máximo de tokens de cada entrada no banco de dados (0 para o máximo do modelo):", CHUNK_TOKENS))
+        chunk_overlap = int(st.text_input("Escolha quantos tokens entradas consecutivas compartilham:", CHUNK_OVERLAP))
 
         st.write('')
         st.write('Para múltiplos valores, separe por vírgula.') 
@@ -298,11 +305,12 @@ def handle_scraper_adv_set(html_cleanup):
     else:
         # Applying default values if not changed in advanced config
         max_depth = MAX_DEPTH
-        max_phrases = MAX_PHRASES
+        chunk_tokens = CHUNK_TOKENS
+        chunk_overlap = CHUNK_OVERLAP
 
-    return max_depth, max_phrases, html_cleanup
+    return max_depth, chunk_tokens, chunk_overlap, html_cleanup
 
-def handle_scraping(data_dir, data_directories, max_depth, html_cleanup, max_phrases, context):
+def handle_scraping(data_dir, data_directories, max_depth, html_cleanup, chunk_tokens, chunk_overlap, context, collect_garbage=False):
     # Page Scraper
 
     start = time.time()
@@ -324,7 +332,7 @@ def handle_scraping(data_dir, data_directories, max_depth, html_cleanup, max_phr
     start = time.time()
 
     try:
-        output, code = scraper(html_cleanup, max_phrases, context) # scrape pages
+        output, code = scraper(html_cleanup, chunk_tokens, chunk_overlap, context, collect_garbage) # scrape pages
     except BaseError as e:
         st.write(f"Erro ao realizar scraping: {e}")
         return
@@ -335,6 +343,9 @@ def handle_scraping(data_dir, data_directories, max_depth, html_cleanup, max_phr
 
     st.write("Scraper OK" if code == 200 else f"Erro em Scraper: code={code}")
 
+    if collect_garbage and code == 200:
+        st.write(f"Limpeza: {output['removed_chunks']} trechos e {output['removed_references']} referências removidos, {output['reclaimed_bytes'] / 2**20:.2f}MB liberados. O contexto tem {output['remaining_chunks']} trechos.")
+
 # FOR LLM
 llm_configs = {
     "default_answer" : "Não encontrei a resposta para sua pergunta.",
@@ -342,7 +353,9 @@ llm_configs = {
     "temperature" : 0.7,
     "top_p" : 0.95,
     "max_tokens" : 400,
-    "llm_model" : "llama2"
+    "llm_model" : "llama2",
+    # Comma separated URL prefixes the answers are restricted to, empty searches every page
+    "url_filter" : ""
 }
 
 def llm_page():
@@ -395,6 +408,10 @@ def chatbot_page():
 
     handle_chatbot_session_state()
 
+    # Loading the LLM before the first question, it stays loaded for every session
+    with st.spinner("Carregando modelo..."):
+        get_llm().models.get(st.session_state.llm_configs['llm_model'])
+
     question = st.chat_input("Qual a sua dúvida?")
 
     if question:
@@ -412,23 +429,60 @@ def handle_llm_qa(question, collections):
     with st.chat_message("bot"):
         message_placeholder = st.empty()
 
-        start = time.time()
-        
-        llm = LLM()
+        stats_placeholder = st.empty()
 
-        logger.debug(f"LLM initialization took {time.time() - start:.2f}s")
+        llm = get_llm()
 
         start = time.time()
+        first_token = None
+        tokens = 0
+        streamed = ''
+        answer = None
+
+        # Showing the answer while it's generated
+        try:
+            for event, value in llm.stream(question, collections, **st.session_state.llm_configs):
+                if event == TOKEN_EVENT:
+                    if first_token is None:
+                        first_token = time.time()
+
+                    tokens += 1
+                    streamed += value
+                    message_placeholder.markdown(streamed + "▌")
 
-        answer = llm(question, collections, **st.session_state.llm_configs)
+                elif event == RESET_EVENT:
+                    # That context didn't have the answer, the next one is being tried
+                    streamed = ''
+                    message_placeholder.markdown("")
 
-        logger.info(f"LLM took {(time.time() - start)/60:.2f}m")
+                elif event == QUEUE_EVENT:
+                    # Other users are generating, the answer starts when its turn comes
+                    message_placeholder.markdown(f"Aguardando a vez de gerar a resposta, posição na fila: {value}")
+
+                elif event == ANSWER_EVENT:
+                    answer = value
+
+        except SchedulerError as e:
+            logger.warning(f"Request refused by the scheduler: {e}")
+            answer = f"Servidor ocupado, tente novamente em instantes ({e})"
+
+        end = time.time()
+
+        if first_token is not None:
+            stats_placeholder.caption(f"Primeiro token em {first_token - start:.1f}s, {tokens / max(end - first_token, 1e-9):.1f} tokens/s")
+
+        logger.info(f"LLM took {(end - start)/60:.2f}m")
         logger.info(f"LLM answer: {answer}")
 
         msg = {"role": "bot", "content": answer}
         st.session_state.messages.append(msg)
         message_placeholder.markdown(answer)
 
+# Single LLM for the whole process, its model is loaded once and reused by every message and session
+@st.cache_resource
+def get_llm():
+    return LLM()
+
 def write_chatbox(): #BUG rewrites all previous messages each time 
     # Display chat messages from history on app rerun
     for message in st.session_state.messages:
@@ -450,6 +504,9 @@ def handle_chatbot_session_state():
 # Define main function to control page selection
 def main():
 
+    # Loading and warming up the embedding model when the app starts, every session and question reuses it
+    get_embedding_service(MODEL_NAME)
+
     st.sidebar.title("Navegação")
 
     pages = {
@@ -0,0 +1,175 @@
+import os
+import json
+from pathlib import Path # easy directory path creation
+
+import numpy as np
+
+from exceptions import BaseError
+from vector_math import squared_l2, top_k
+
+COMPACT_DTYPES = ('float16', 'int8')
+
+# Amount of candidates re-scored with full precision vectors for each result requested
+RESCORE_FACTOR = 4
+# Rows scored at once, so the temporary float32 copy of int8 codes stays small
+SEARCH_BLOCK = 65536
+# Rows used to fit the PCA
+PCA_SAMPLE = 20000
+
+META_FILE = 'meta.json'
+IDS_FILE = 'ids.json'
+ARRAY_FILES = ('mean', 'components', 'scale', 'codes', 'norms')
+
+class CompactIndex():
+
+    """
+    Compressed copy of the vectors of a collection, reduced with PCA (fitted on the collection) and quantized to float16 or int8.
+    Searches score every compact vector, and the best candidates are re-scored with their full precision vectors.
+    """
+
+    def __init__(self, ids, mean, components, scale, codes, dtype, norms=None):
+
+        self.ids = list(ids)
+        self.mean = mean
+        self.components = components # (dims, original dims), None when there's no dimensionality reduction
+        self.scale = scale # per dimension scale of int8 codes, None for float16
+        self.codes = codes
+        self.dtype = dtype
+
+        # Norms of the dequantized vectors, used by squared_l2
+        if norms is None:
+            norms = np.concatenate([np.einsum('ij,ij->i', block, block) for block in self.blocks()]) if len(self.ids) else np.zeros(0, dtype=np.float32)
+
+        self.norms = norms
+
+    @classmethod
+    def fit(cls, ids, embeddings, dtype='int8', dims=0, seed=0):
+
+        if dtype not in COMPACT_DTYPES:
+            raise BaseError(f"Compact vector type must be one of {COMPACT_DTYPES}, received {dtype}")
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        mean = embeddings.mean(axis=0)
+
+        components = None
+
+        # PCA through SVD of a sample of the centered vectors, keeping the dims directions with most variance
+        if dims and dims < embeddings.shape[1]:
+            rng = np.random.default_rng(seed)
+            sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), PCA_SAMPLE), replace=False)]
+
+            _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+            components = vt[:dims].astype(np.float32)
+
+        reduced = project(embeddings, mean, components)
+
+        scale = None
+
+        if dtype == 'int8':
+            # Symmetric scalar quantization, each dimension scaled so its largest absolute value becomes 127
+            scale = np.abs(reduced).max(axis=0) / 127
+            scale[scale == 0] = 1
+            codes = np.clip(np.rint(reduced / scale), -127, 127).astype(np.int8)
+        else:
+            codes = reduced.astype(np.float16)
+
+        return cls(ids, mean, components, scale.astype(np.float32) if scale is not None else None, codes, dtype)
+
+    def blocks(self):
+        # Dequantized vectors, one block of rows at a time
+        for start in range(0, len(self.codes), SEARCH_BLOCK):
+            block = self.codes[start:start + SEARCH_BLOCK].astype(np.float32)
+            yield block * self.scale if self.scale is not None else block
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.mean, self.components, self.scale, self.codes, self.norms) if array is not None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query_embedding, k, fetch_full=None, rescore_factor=RESCORE_FACTOR):
+
+        """
+        Returns the ids and squared l2 distances of the k nearest vectors.
+        fetch_full(ids) must return the full precision vectors of the ids, if it is None the approximate distances are returned.
+        """
+
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+
+        query = project(query_embedding[None, :], self.mean, self.components)
+
+        # Approximate distances in the compact space
+        distances = np.concatenate([
+            squared_l2(query, block, self.norms[start:start + len(block)])[0]
+            for start, block in zip(range(0, len(self.codes), SEARCH_BLOCK), self.blocks())
+        ])
+
+        if fetch_full is None:
+            positions = top_k(distances, k)
+            return [self.ids[i] for i in positions], distances[positions].tolist()
+
+        candidates = [self.ids[i] for i in top_k(distances, k * rescore_factor)]
+
+        # Re-scoring the candidates exactly with their original vectors
+        exact = squared_l2(query_embedding, np.asarray(fetch_full(candidates), dtype=np.float32))[0]
+
+        positions = top_k(exact, k)
+
+        return [candidates[i] for i in positions], exact[positions].tolist()
+
+    def save(self, directory):
+
+        # if path to file doesn't exist, create it and its parents
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+        # Removing meta.json first, so an index being rewritten is never loaded
+        if os.path.exists(os.path.join(directory, META_FILE)):
+            os.remove(os.path.join(directory, META_FILE))
+
+        arrays = dict(zip(ARRAY_FILES, (self.mean, self.components, self.scale, self.codes, self.norms)))
+
+        for name, array in arrays.items():
+            path = os.path.join(directory, f"{name}.npy")
+            if array is not None:
+                np.save(path, array)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        with open(os.path.join(directory, IDS_FILE), 'w', encoding='utf8') as f:
+            json.dump(self.ids, f)
+
+        # Written last, an index without meta.json is treated as missing
+        with open(os.path.join(directory, META_FILE), 'w', encoding='utf8') as f:
+            json.dump({'dtype' : self.dtype, 'count' : len(self.ids), 'dims' : int(self.codes.shape[1]) if len(self.codes.shape) > 1 else 0}, f)
+
+    @classmethod
+    def load(cls, directory):
+
+        if not os.path.exists(os.path.join(directory, META_FILE)):
+            return None
+
+        with open(os.path.join(directory, META_FILE), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+
+        with open(os.path.join(directory, IDS_FILE), 'r', encoding='utf8') as f:
+            ids = json.load(f)
+
+        arrays = {}
+
+        for name in ARRAY_FILES:
+            path = os.path.join(directory, f"{name}.npy")
+            # Codes are memory-mapped, they are only read while searching
+            arrays[name] = np.load(path, mmap_mode='r' if name == 'codes' else None) if os.path.exists(path) else None
+
+        return cls(ids, arrays['mean'], arrays['components'], arrays['scale'], arrays['codes'], meta['dtype'], arrays['norms'])
+
+def project(embeddings, mean, components):
+
+    centered = embeddings - mean
+
+    if components is None:
+        return centered
+
+    return centered @ components.T
@@ -1,13 +1,25 @@
-#database library for semantic search
-import chromadb
-from chromadb.utils import embedding_functions
+import numpy as np
 
 #importing environ variables
 import os
 from dotenv import load_dotenv
 import uuid
+import time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from logger_config import configure_logger
+from EmbeddingCache import get_embedding_cache
+from EmbeddingService import get_embedding_service
+from CompactIndex import CompactIndex
+from BM25Index import BM25Index
+from PageIndex import PageIndex
+from ReferenceTable import ReferenceTable, REFERENCES_FILE, url_parts
+from vector_math import space_distances, reciprocal_rank_fusion, top_k
+# storage engine for semantic search
+from VectorStore import create_store, hnsw_metadata, collection_space, CHROMA_ID, CHROMA_METADATA, CHROMA_DOCUMENTS, CHROMA_EMBEDDINGS, CHROMA_DISTANCES
+from ShardedStore import SITE_KEY
 
 # Obtaining environment variables for default database definition
 load_dotenv(override=True)
@@ -21,28 +33,503 @@ try:
 except Exception as e:
     MODEL_NAME = "sentence-transformers/distiluse-base-multilingual-cased-v1"
 
-#Fixed names from chromadb
-CHROMA_ID = "ids"
-CHROMA_METADATA = "metadatas"
+# Storage engine of the collections: 'chroma' or 'numpy' (exact search over a memory-mapped matrix)
+VECTOR_STORE = os.getenv('VECTOR_STORE', 'chroma')
 
-# Values to organize data within ChromaDB
+# Directory of the indexes built alongside each collection, one sub directory for each kind of index
+PATH_INDEXES = os.getenv('PATH_INDEXES', 'indexes')
+COMPACT_INDEX = 'compact'
+BM25_INDEX = 'bm25'
+PAGE_INDEX = 'pages'
+INDEX_CLASSES = {COMPACT_INDEX : CompactIndex, BM25_INDEX : BM25Index, PAGE_INDEX : PageIndex}
+# Version of the collection each index was built from, written next to its files once it's saved
+INDEX_VERSION_FILE = 'version.json'
+
+# Optional compact vectors used for searching instead of ChromaDB's index: '' (disabled), 'float16' or 'int8'
+COMPACT_VECTORS = os.getenv('COMPACT_VECTORS', '')
+# Dimensions kept by PCA in compact vectors, 0 keeps all of them
+COMPACT_DIMENSIONS = int(os.getenv('COMPACT_DIMENSIONS', 0))
+
+# Two-stage search, selecting the nearest pages by the mean of their chunks and then ranking only the chunks of those pages
+HIERARCHICAL_SEARCH = os.getenv('HIERARCHICAL_SEARCH', 'false').lower() == 'true'
+
+# Fusing vector search results with BM25 lexical search, with a BM25 index built alongside each collection
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', 'true').lower() == 'true'
+# Constant of reciprocal rank fusion, higher values give less weight to the first positions of each ranking
+RRF_K = int(os.getenv('RRF_K', 60))
+
+# Values to organize data within ChromaDB, URL and section are only present in collections stored before the reference table
 URL_KEY = 'url'
 SECTION_KEY = 'section'
+TOKENS_KEY = 'tokens'
+
+# Amount of chunks sent to ChromaDB on each call, the embedding model runs over the whole batch at once
+BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', 1000))
+
+# Token budget of each chunk, 0 uses the most tokens the embedding model reads without truncating
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', 0))
+# Tokens repeated between consecutive chunks of the same page, so content divided between them is not lost
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 16))
+
+# Reusing embeddings already computed for the same content, across collections and rebuilds
+USE_EMBEDDING_CACHE = os.getenv('USE_EMBEDDING_CACHE', 'true').lower() == 'true'
+
+# Chunk IDs are generated from their content, so the same text always has the same ID
+def chunk_id(content):
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, content))
+
+# Site of the first page of a chunk, stored with it so chunks can be routed to shards by site
+def url_metadata(url):
+    return {SITE_KEY : url_parts(url)[0]}
+
+# (site, components) of each of the comma separated URL prefixes, [] when there's nothing to filter
+def url_prefixes(url_filter):
+    return [url_parts(prefix.strip()) for prefix in (url_filter or '').split(',') if prefix.strip()]
+
+# If url is under one of the prefixes, a prefix without site matches every site
+def url_matches(url, prefixes):
+
+    site, components = url_parts(url)
+
+    return any((not prefix_site or prefix_site == site) and components[:len(prefix_components)] == prefix_components for prefix_site, prefix_components in prefixes)
+
+# Splits a list into lists of at most size items
+def batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Divides a sentence longer than max_tokens into windows of max_tokens tokens, using the character span of each token
+def split_by_tokens(phrase, spans, max_tokens, overlap):
+
+    pieces = []
+    step = max(max_tokens - overlap, 1)
+
+    for start in range(0, len(spans), step):
+        window = spans[start:start + max_tokens]
+        pieces.append((phrase[window[0][0]:window[-1][1]], len(window)))
+
+        if start + max_tokens >= len(spans):
+            break
+
+    return pieces
+
+# Groups consecutive (sentence, tokens) units into chunks of at most max_tokens tokens, each chunk starting with the last sentences of the previous one
+def pack_by_tokens(units, max_tokens, overlap):
+
+    chunks = []
+    current, current_tokens = [], 0
+
+    for text, tokens in units:
+
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(('\n'.join(unit[0] for unit in current), current_tokens))
+
+            # Carrying the last sentences of the chunk to the next one, up to overlap tokens
+            carried, carried_tokens = [], 0
+            for unit in reversed(current):
+                if carried_tokens + unit[1] > overlap:
+                    break
+                carried.insert(0, unit)
+                carried_tokens += unit[1]
+
+            # If the overlap and the new sentence don't fit together, the overlap is dropped
+            if carried_tokens + tokens > max_tokens:
+                carried, carried_tokens = [], 0
+
+            current, current_tokens = carried, carried_tokens
+
+        current.append((text, tokens))
+        current_tokens += tokens
+
+    # Append what was missing
+    if current:
+        chunks.append(('\n'.join(unit[0] for unit in current), current_tokens))
+
+    return chunks
 
 class DB():
-    def __init__(self, path=PATH_DB, model_name=MODEL_NAME):
+    def __init__(self, path=PATH_DB, model_name=MODEL_NAME, indexes_path=PATH_INDEXES, vector_store=VECTOR_STORE):
 
         self.logger = configure_logger(f'DB', 'debug', 'logs')
-        self.logger.info(f"Loading database at {path}")
+        self.logger.info(f"Loading {vector_store} database at {path}")
+
+        # Initializing storage engine and embedding function for the database
+        self.store = create_store(vector_store, path)
+
+        # Length-bucketed embedding function, used by ChromaDB for queries and by self.embed for documents
+        # The model is loaded only by the first DB of the process, the others share it
+        self.ef = get_embedding_service(model_name)
+
+        # Cached by the name of the vectors, so int8 quantized embeddings never mix with the full precision ones
+        self.cache = get_embedding_cache(self.ef.embedding_name) if USE_EMBEDDING_CACHE else None
+
+        self.indexes_path = indexes_path
+
+        # URLs and sections of each chunk { collection, chunk } -> [(url, section)]
+        self.references = ReferenceTable(os.path.join(indexes_path, REFERENCES_FILE))
+
+        # Indexes already loaded, with the version of the collection they were built from { kind : { collection name : (version, index) } }
+        self.indexes = {kind : {} for kind in INDEX_CLASSES}
+
+        # Stale indexes are rebuilt in the background, one at a time, while searches go without them { (kind, collection name) }
+        self.rebuilding = set()
+        self.index_lock = threading.Lock()
+        self.index_pool = ThreadPoolExecutor(max_workers=1)
+
+    # Pages of each chunk, only looked up for the chunks that are going to be shown { id : [(url, section)] }
+    def resolve_references(self, collection_name, ids):
+        return self.references.resolve(collection_name, ids)
+
+    def collection_versions(self, collection_names):
+        return self.references.versions(collection_names)
+
+    def index_directory(self, kind, collection_name):
+        return os.path.join(self.indexes_path, kind, collection_name)
+
+    def embed(self, ids, documents):
+
+        """
+        Returns the embeddings of the documents, computing only the ones that are not in the embedding cache
+        """
+
+        if self.cache is None:
+            return self.ef.encode(documents).tolist()
+
+        embeddings = self.cache.lookup(ids)
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        self.logger.debug(f"Embedding cache: {len(ids) - len(missing)} hits, {len(missing)} misses")
+
+        if missing:
+            computed = self.ef.encode([documents[i] for i in missing])
+
+            self.cache.store([ids[i] for i in missing], computed)
+
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+
+        return np.stack(embeddings).tolist()
+
+    def embed_query(self, question):
+        return self.ef.encode([question])[0]
+
+    # Stored embeddings of the ids, read from the embedding cache when possible
+    def full_embeddings(self, collection, ids):
+
+        embeddings = self.cache.lookup(ids) if self.cache is not None else [None] * len(ids)
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        if missing:
+            stored = collection.get(ids=[ids[i] for i in missing], include=[CHROMA_EMBEDDINGS])
+            stored = dict(zip(stored[CHROMA_ID], stored[CHROMA_EMBEDDINGS]))
+
+            for i in missing:
+                embeddings[i] = np.asarray(stored[ids[i]], dtype=np.float32)
+
+        return np.stack(embeddings)
+
+    # Goes through every chunk stored in the collection, batch_size at a time
+    def iterate_collection(self, collection, include, batch_size=BATCH_SIZE):
+
+        offset = 0
+
+        while True:
+            batch = collection.get(include=include, limit=batch_size, offset=offset)
+
+            if not batch[CHROMA_ID]:
+                break
+
+            yield batch
+
+            offset += len(batch[CHROMA_ID])
+
+    def build_compact_index(self, collection, dtype=COMPACT_VECTORS, dims=COMPACT_DIMENSIONS):
+
+        ids, embeddings = [], []
+
+        for batch in self.iterate_collection(collection, [CHROMA_EMBEDDINGS]):
+            ids.extend(batch[CHROMA_ID])
+            embeddings.extend(batch[CHROMA_EMBEDDINGS])
+
+        if not ids:
+            self.logger.warning(f"No chunks in {collection.name}, compact index not built")
+            return None
+
+        start = time.time()
+
+        index = CompactIndex.fit(ids, embeddings, dtype=dtype, dims=dims)
+        index.save(self.index_directory(COMPACT_INDEX, collection.name))
+
+        self.logger.info(f"Compact index of {collection.name} ({dtype}, {dims or 'all'} dims) built in {time.time() - start:.2f}s: {index.nbytes / 2**20:.1f}MB instead of {len(ids) * len(embeddings[0]) * 4 / 2**20:.1f}MB")
+
+        return index
+
+    def build_page_index(self, collection):
+
+        ids, embeddings = [], []
+
+        for batch in self.iterate_collection(collection, [CHROMA_EMBEDDINGS]):
+            ids.extend(batch[CHROMA_ID])
+            embeddings.extend(batch[CHROMA_EMBEDDINGS])
+
+        if not ids:
+            self.logger.warning(f"No chunks in {collection.name}, page index not built")
+            return None
+
+        start = time.time()
+
+        index = PageIndex.build(ids, embeddings, self.references.chunk_pages(collection.name))
+        index.save(self.index_directory(PAGE_INDEX, collection.name))
+
+        self.logger.info(f"Page index of {collection.name} built in {time.time() - start:.2f}s: {len(index)} pages, {index.chunks_per_page:.1f} chunks per page")
+
+        if not index.complete:
+            self.logger.warning(f"{len(index.ids) - index.covered} of {len(index.ids)} chunks of {collection.name} have no reference, it's searched without its page index until it's ingested again")
+
+        return index
+
+    def build_bm25_index(self, collection):
+
+        start = time.time()
+
+        ids, documents = [], []
+
+        for batch in self.iterate_collection(collection, [CHROMA_DOCUMENTS]):
+            ids.extend(batch[CHROMA_ID])
+            documents.extend(batch[CHROMA_DOCUMENTS])
+
+        index = BM25Index.build(ids, documents)
+        index.save(self.index_directory(BM25_INDEX, collection.name))
+
+        self.logger.info(f"BM25 index of {collection.name} built in {time.time() - start:.2f}s: {len(index)} documents, {len(index.vocabulary)} terms")
+
+        return index
+
+    def build_index(self, kind, collection):
+
+        builders = {COMPACT_INDEX : self.build_compact_index, BM25_INDEX : self.build_bm25_index, PAGE_INDEX : self.build_page_index}
+
+        return builders[kind](collection)
+
+    def index_version(self, kind, name):
+
+        path = os.path.join(self.index_directory(kind, name), INDEX_VERSION_FILE)
+
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r', encoding='utf8') as f:
+            return json.load(f)['version']
+
+    def rebuild_index(self, kind, collection):
+
+        """
+        Builds the index of kind of the collection and tags it with the version the collection had before its chunks were read,
+        so changes made while building leave it stale
+        """
+
+        directory = self.index_directory(kind, collection.name)
+
+        try:
+            version = self.collection_versions([collection.name])[collection.name]
+
+            # Untagged while it's rewritten, so it's never taken for the new version half written
+            if os.path.exists(os.path.join(directory, INDEX_VERSION_FILE)):
+                os.remove(os.path.join(directory, INDEX_VERSION_FILE))
+
+            index = self.build_index(kind, collection)
+
+            if index is not None:
+                with open(os.path.join(directory, INDEX_VERSION_FILE), 'w', encoding='utf8') as f:
+                    json.dump({'version' : version}, f)
 
-        # Initializing client and embedding function for Chromadb Database
-        self.client = chromadb.PersistentClient(path=path)
+            self.indexes[kind][collection.name] = (version, index)
 
-        self.ef = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
+        except Exception as e:
+            self.logger.error(f"Failed to build the {kind} index of {collection.name}: {e}")
 
-    def prepare_for_db(self, data:dict, max_phrases):
+        finally:
+            with self.index_lock:
+                self.rebuilding.discard((kind, collection.name))
 
-        # Function to divide content into sentences to facilitate database searching
+    def schedule_rebuild(self, kind, collection):
+
+        with self.index_lock:
+            if (kind, collection.name) in self.rebuilding:
+                return
+
+            self.rebuilding.add((kind, collection.name))
+
+        self.logger.info(f"The {kind} index of {collection.name} is missing or outdated, rebuilding it in the background")
+
+        self.index_pool.submit(self.rebuild_index, kind, collection)
+
+    def load_index(self, kind, collection):
+
+        """
+        Returns the index of kind of the collection, or None while it's missing or older than the collection.
+        Ingestion (possibly by another DB of the process, like the scraper's) only changes the collection version, so the version
+        is checked on every search: a loaded index is reloaded from disk or rebuilt as soon as the collection changes
+        """
+
+        name = collection.name
+
+        version = self.collection_versions([name])[name]
+
+        if name in self.indexes[kind] and self.indexes[kind][name][0] == version:
+            return self.indexes[kind][name][1]
+
+        if self.index_version(kind, name) != version:
+            self.schedule_rebuild(kind, collection)
+            return None
+
+        index = INDEX_CLASSES[kind].load(self.index_directory(kind, name))
+
+        self.indexes[kind][name] = (version, index)
+
+        return index
+
+    def url_filter_ids(self, collection, url_filter):
+
+        """
+        IDs of the chunks of the collection that appear in at least one page under the comma separated URL prefixes of url_filter.
+        Every page of a chunk counts, not only the first one it was found in
+        """
+
+        prefixes = url_prefixes(url_filter)
+
+        if self.references.has_references(collection.name):
+            return self.references.prefix_chunks(collection.name, prefixes)
+
+        # Collections stored before the reference table keep their pages in the url metadata of each chunk, read from every chunk
+        self.logger.warning(f"{collection.name} has no references, filtering by the url metadata of every chunk. Ingest it again to filter through the reference table")
+
+        allowed = set()
+
+        for batch in self.iterate_collection(collection, [CHROMA_METADATA]):
+            for id, metadata in zip(batch[CHROMA_ID], batch[CHROMA_METADATA]):
+                urls = str((metadata or {}).get(URL_KEY, '')).split(' , ')
+
+                if any(url_matches(url, prefixes) for url in urls if url.strip()):
+                    allowed.add(id)
+
+        return allowed
+
+    # Exact search over the chunks of ids only, their embeddings are read from the embedding cache when possible
+    def query_subset(self, collection, ids, query_embedding, n_results, batch_size=BATCH_SIZE):
+
+        ids = list(ids)
+
+        if not ids:
+            return self.query_result(collection, [], [])
+
+        space = collection_space(collection)
+
+        distances = np.concatenate([space_distances(query_embedding, self.full_embeddings(collection, batch), space)[0] for batch in batched(ids, batch_size)])
+
+        best = top_k(distances, n_results)
+
+        return self.query_result(collection, [ids[i] for i in best], distances[best].tolist())
+
+    # Nearest n_results chunks of the question, in the same format as collection.query
+    # url_filter restricts the search to pages under comma separated URL prefixes, e.g. "ppgia.pucpr.br/pt/doutorado, ppgia.pucpr.br/pt/mestrado"
+    # query_embedding is the embedding of the question, when the caller already has it
+    def query(self, collection, question, n_results, url_filter='', query_embedding=None):
+
+        if query_embedding is None:
+            query_embedding = self.embed_query(question)
+
+        # Page and compact indexes rank by l2, collections in other spaces are always searched by the storage engine
+        l2 = collection_space(collection) == 'l2'
+
+        # Chunks of the pages under the prefixes, resolved through the reference table
+        allowed = self.url_filter_ids(collection, url_filter) if url_prefixes(url_filter) else None
+
+        if allowed is not None:
+            self.logger.debug(f"{len(allowed)} chunks under {url_filter} in {collection.name}")
+            query = self.query_subset(collection, allowed, query_embedding, n_results)
+        elif not l2:
+            query = collection.query(query_embeddings=[query_embedding.tolist()], n_results=n_results)
+        elif HIERARCHICAL_SEARCH and (pages := self.load_index(PAGE_INDEX, collection)) is not None and pages.complete:
+            query = self.query_result(collection, *pages.search(query_embedding, n_results))
+        elif COMPACT_VECTORS and (index := self.load_index(COMPACT_INDEX, collection)) is not None:
+            query = self.query_compact(collection, index, query_embedding, n_results)
+        else:
+            query = collection.query(query_embeddings=[query_embedding.tolist()], n_results=n_results)
+
+        if HYBRID_SEARCH and (bm25 := self.load_index(BM25_INDEX, collection)) is not None:
+            query = self.fuse_lexical(collection, bm25, question, query_embedding, query, n_results, allowed)
+
+        return query
+
+    # Reciprocal rank fusion of the vector search results with the BM25 results
+    # allowed is the set of IDs a filtered search is restricted to
+    def fuse_lexical(self, collection, bm25, question, query_embedding, query, n_results, allowed=None):
+
+        start = time.time()
+
+        lexical_ids, _ = bm25.search(question, n_results)
+
+        if allowed is not None:
+            lexical_ids = [id for id in lexical_ids if id in allowed]
+
+        self.logger.debug(f"BM25 search took {(time.time() - start) * 1000:.3f}ms")
+
+        vector_ids = query[CHROMA_ID][0]
+
+        ids = reciprocal_rank_fusion([vector_ids, lexical_ids], k=RRF_K)[:n_results]
+
+        # Chunks found only by BM25 get their vector distance computed, so the distance threshold still applies to them
+        distances = dict(zip(vector_ids, query[CHROMA_DISTANCES][0]))
+
+        if missing := [id for id in ids if id not in distances]:
+            distances.update(zip(missing, space_distances(query_embedding, self.full_embeddings(collection, missing), collection_space(collection))[0].tolist()))
+
+        return self.query_result(collection, ids, [distances[id] for id in ids])
+
+    def query_compact(self, collection, index, query_embedding, n_results):
+
+        # Candidates found with the compact vectors are re-scored with the full precision ones
+        ids, distances = index.search(query_embedding, n_results, fetch_full=lambda ids: self.full_embeddings(collection, ids))
+
+        return self.query_result(collection, ids, distances)
+
+    # Formats ids and distances found outside of ChromaDB like the output of collection.query
+    def query_result(self, collection, ids, distances):
+
+        # Nothing found, ChromaDB rejects get with an empty list of IDs
+        if not ids:
+            return {CHROMA_ID : [[]], CHROMA_DOCUMENTS : [[]], CHROMA_METADATA : [[]], CHROMA_DISTANCES : [[]]}
+
+        stored = collection.get(ids=ids, include=[CHROMA_DOCUMENTS, CHROMA_METADATA])
+        stored = {id : (document, metadata) for id, document, metadata in zip(stored[CHROMA_ID], stored[CHROMA_DOCUMENTS], stored[CHROMA_METADATA])}
+
+        # Chunks removed after the index was built are skipped
+        found = [(id, distance) for id, distance in zip(ids, distances) if id in stored]
+
+        return {
+            CHROMA_ID : [[id for id, _ in found]],
+            CHROMA_DOCUMENTS : [[stored[id][0] for id, _ in found]],
+            CHROMA_METADATA : [[stored[id][1] for id, _ in found]],
+            CHROMA_DISTANCES : [[distance for _, distance in found]]
+        }
+
+    def prepare_for_db(self, data:dict, chunk_tokens=None, chunk_overlap=CHUNK_OVERLAP):
+
+        """
+        Divides the content of each page into chunks of at most chunk_tokens tokens of the embedding model,
+        returning { url : [(chunk, tokens)] }. Consecutive chunks share up to chunk_overlap tokens.
+        """
+
+        # By default chunks are as long as the embedding model can read without truncating
+        if not chunk_tokens:
+            chunk_tokens = CHUNK_TOKENS or self.ef.max_tokens
+
+        chunk_overlap = min(chunk_overlap, chunk_tokens // 2)
+
+        self.logger.info(f"Dividing content into chunks of {chunk_tokens} tokens with {chunk_overlap} tokens of overlap")
 
         output = {}
 
@@ -56,19 +543,19 @@ class DB():
                 self.logger.warning(f"{metadata} is not a string type, it is: {type(metadata)}")
                 continue
 
-            sectioned_content = []
-
             # Dividing into sentences if the sentence is not null
             phrases = [phrase for phrase in content.split('\n') if phrase.strip()]
 
-            # If there are more phrases than max_phrases, we combine them each max_phrases
-            while len(phrases) >= max_phrases:
-                sectioned_content.append('\n'.join(phrases[:max_phrases]))
-                phrases = phrases[max_phrases:]
+            # Sentences and their token count, sentences longer than the budget are split at token boundaries
+            units = []
+
+            for phrase, spans in zip(phrases, self.ef.token_spans(phrases)):
+                if len(spans) > chunk_tokens:
+                    units.extend(split_by_tokens(phrase, spans, chunk_tokens, chunk_overlap))
+                elif spans:
+                    units.append((phrase, len(spans)))
 
-            # Append what was missing
-            if phrases and len(phrases) < max_phrases: # redundante?
-                sectioned_content.append('\n'.join(phrases))
+            sectioned_content = pack_by_tokens(units, chunk_tokens, chunk_overlap)
 
             # Adding the metadata and split content to the output
             output[metadata] = sectioned_content
@@ -77,23 +564,23 @@ class DB():
 
         return output
     
-    def create_collection(self, context):
-        return self.client.get_or_create_collection(name = context, embedding_function=self.ef)
+    # New collections get the HNSW settings of the environment, overridden by metadata. Existing ones keep theirs
+    def create_collection(self, context, metadata=None):
+        return self.store.create_collection(name = context, embedding_function=self.ef, metadata={**hnsw_metadata(), **(metadata or {})})
 
-    def store_in_db(self, data, collection):
+    # Raises ValueError if the collection doesn't exist
+    def get_collection(self, name):
+        return self.store.get_collection(name = name, embedding_function=self.ef)
+
+    def chunk_references(self, data):
 
         """
-        Data variable must be a dictionary of URL keys with their values in list format { url : [content] }
+        Returns the chunks of data { id : [content, metadata] } and the pages where each one appears [(id, url, section)]
         """
 
-
-        # Getting the data currently present within the collection
-        collection_data = collection.get()
-
-        # Get the IDs that have already been used
-        current_ids = collection_data[CHROMA_ID]
-
-        self.logger.info(f"Starting storage at:{collection.name}")
+        # Keyed by ID so repeated content is merged into a single entry
+        chunks = {}
+        references = []
 
         # Getting size of data dictionary to be stored
         urls_ammount = len(data)
@@ -104,41 +591,110 @@ class DB():
             # log to represent storage progress
             self.logger.debug(f"{j+1}/{urls_ammount}") #ADD for deep debugging, too much data for normal usage
 
-            for i, sectioned_content in enumerate(content):
+            for i, (sectioned_content, tokens) in enumerate(content):
+
+                id = chunk_id(sectioned_content)
+
+                references.append((id, url, i))
+
+                # Chunks are routed to shards by the site of the first page they were found in
+                if id not in chunks:
+                    chunks[id] = [sectioned_content, {TOKENS_KEY : tokens, **url_metadata(url)}]
+
+        return chunks, references
+
+    def store_in_db(self, data, collection, batch_size=BATCH_SIZE):
+
+        """
+        Data variable must be a dictionary of URL keys with their values in list format { url : [(content, tokens)] }, as returned by prepare_for_db
+        """
+
+        self.logger.info(f"Starting storage at:{collection.name}")
+
+        start = time.time()
+
+        chunks, references = self.chunk_references(data)
+
+        # Looking up only the IDs of this ingestion that are already stored, instead of fetching the whole collection
+        stored_ids = set()
+
+        for ids in batched(list(chunks), batch_size):
+            stored_ids.update(collection.get(ids=ids, include=[])[CHROMA_ID])
+
+        # Stored chunks have the same content (their ID comes from it), only new ones need to be embedded
+        new_ids = [id for id in chunks if id not in stored_ids]
+
+        try:
+            # Upserting in large batches so the embedding model runs over many chunks at once
+            for ids in batched(new_ids, batch_size):
+                documents = [chunks[id][0] for id in ids]
+                collection.upsert(ids=ids, documents=documents, metadatas=[chunks[id][1] for id in ids], embeddings=self.embed(ids, documents))
+                self.logger.debug(f"Stored batch of {len(ids)} chunks")
+
+        except Exception as e:
+            return e, 400
+
+        new_references = self.references.add(collection.name, references)
+
+        # Indexes and cached answers of the collection are outdated, the indexes are rebuilt when they're next searched
+        if new_ids or new_references:
+            self.references.bump_version(collection.name)
 
-                id = str(uuid.uuid5(uuid.NAMESPACE_DNS, sectioned_content))
+        self.logger.info(f"{len(chunks)} chunks: {len(new_ids)} new, {len(chunks) - len(new_ids)} already stored. {new_references} new references")
 
-                if id in current_ids:
+        elapsed = time.time() - start
 
-                    # Getting position in the list of IDs
-                    pos = current_ids.index(id)
+        self.logger.info(f"Finished storage. {len(chunks)} chunks in {elapsed:.2f}s ({len(chunks) / max(elapsed, 1e-9):.2f} chunks/s)")
 
-                    # Obtaining the metadata from the obtained position
-                    metadata = collection_data[CHROMA_METADATA][pos]
+        return {}, 200
 
-                    # Checking if URL has not already been stored in this collection
-                    if url in metadata[URL_KEY]:
-                        break
+    def collect_garbage(self, data, collection, remove_missing_pages=True, batch_size=BATCH_SIZE):
 
-                    # Adding new data to the stored metadata
-                    metadata[URL_KEY] = f"{metadata[URL_KEY]} , {url}"
-                    metadata[SECTION_KEY] = f"{metadata[SECTION_KEY]} , {i}"
+        """
+        Compares the chunks of each URL in data (the current snapshot, as returned by prepare_for_db) against the stored ones.
+        References to chunks that pages don't have anymore are removed (and of pages not in data, if remove_missing_pages),
+        then chunks not referenced by any page are deleted. Returns how much was reclaimed
+        """
+
+        self.logger.info(f"Collecting garbage of {collection.name}")
+
+        start = time.time()
+
+        _, references = self.chunk_references(data)
+
+        removed_references = self.references.remove_stale(collection.name, references, remove_missing_pages)
+
+        referenced = self.references.referenced_chunks(collection.name)
 
-                else:
-                    metadata = {
-                        URL_KEY : url,
-                        SECTION_KEY : i
-                    }
+        # Stored chunks that no page references anymore
+        orphans = []
 
-                    # Adding new values ​​to comparison variables
-                    current_ids.append(id)
-                    collection_data[CHROMA_METADATA].append(metadata)
+        for batch in self.iterate_collection(collection, [], batch_size):
+            orphans.extend(id for id in batch[CHROMA_ID] if id not in referenced)
 
-                try:
-                    collection.upsert(ids=id, documents=sectioned_content, metadatas=metadata)
-                except Exception as e:
-                    return e, 400
+        reclaimed_bytes = 0
 
-        self.logger.info("Finished storage.")
+        for ids in batched(orphans, batch_size):
+            stored = collection.get(ids=ids, include=[CHROMA_DOCUMENTS])
+            reclaimed_bytes += sum(len((document or '').encode('utf-8')) for document in stored[CHROMA_DOCUMENTS])
 
-        return {}, 200
\ No newline at end of file
+            collection.delete(ids=ids)
+
+        # Only the NumPy store can give the space of deleted vectors back and report it, ChromaDB reuses it internally
+        if orphans and hasattr(collection, 'compact'):
+            reclaimed_bytes += collection.compact()
+
+        # Indexes and cached answers of the collection are outdated
+        if orphans or removed_references:
+            self.references.bump_version(collection.name)
+
+        output = {
+            'removed_references' : removed_references,
+            'removed_chunks' : len(orphans),
+            'reclaimed_bytes' : reclaimed_bytes,
+            'remaining_chunks' : collection.count()
+        }
+
+        self.logger.info(f"Garbage collection of {collection.name} took {time.time() - start:.2f}s: {output}")
+
+        return output
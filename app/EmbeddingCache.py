@@ -0,0 +1,175 @@
+import os
+import re
+from pathlib import Path # easy directory path creation
+import threading
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from exceptions import BaseError
+from logger_config import configure_logger
+
+# Directory where the embeddings are kept, one sub directory for each model
+PATH_EMBEDDING_CACHE = os.getenv('PATH_EMBEDDING_CACHE', 'embeddingCache')
+
+VECTORS_FILE = 'vectors.npy'
+KEYS_FILE = 'keys.txt'
+
+# Amount of rows allocated the first time the vectors file is created, doubled every time it fills up
+INITIAL_CAPACITY = 1024
+
+## Process-wide registry, two instances appending to the same files would overwrite each other's rows
+caches = {} # (model_name, path) : EmbeddingCache
+caches_lock = threading.Lock()
+
+def get_embedding_cache(model_name, path=PATH_EMBEDDING_CACHE):
+
+    with caches_lock:
+        if (model_name, path) not in caches:
+            caches[(model_name, path)] = EmbeddingCache(model_name, path)
+
+        return caches[(model_name, path)]
+
+# Model names have slashes, so they are normalized before being used as directory names
+def model_directory_name(model_name):
+    return re.sub(r'[^\w.-]', '_', model_name)
+
+class EmbeddingCache():
+
+    """
+    On-disk cache of embeddings keyed by content hash (the chunk ID), one cache per model.
+    Vectors are kept in a memory-mapped NumPy array, and the keys file stores the key of each row, in order.
+    """
+
+    def __init__(self, model_name, path=PATH_EMBEDDING_CACHE):
+
+        self.logger = configure_logger('EC', 'debug', 'logs')
+
+        self.directory = os.path.join(path, model_directory_name(model_name))
+
+        # if path to file doesn't exist, create it and its parents
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+        self.vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        self.keys_path = os.path.join(self.directory, KEYS_FILE)
+
+        # Several DB instances and threads may share the same files
+        self.lock = threading.Lock()
+
+        self.vectors = None # memmap of shape (capacity, dim)
+        self.index = {} # key : row
+
+        self.load()
+
+        self.logger.info(f"Embedding cache at {self.directory} with {len(self.index)} vectors")
+
+    def load(self):
+
+        if os.path.exists(self.vectors_path):
+            self.vectors = open_memmap(self.vectors_path, mode='r+')
+
+        if not os.path.exists(self.keys_path):
+            return
+
+        with open(self.keys_path, 'r', encoding='utf8') as f:
+            lines = f.readlines()
+
+        capacity = len(self.vectors) if self.vectors is not None else 0
+
+        # Vectors are always flushed before their keys, so only fully written lines within capacity are valid
+        valid_lines = [line for line in lines if line.endswith('\n')][:capacity]
+
+        if len(valid_lines) != len(lines):
+            self.logger.warning(f"Ignoring {len(lines) - len(valid_lines)} incomplete entries in {self.keys_path}")
+
+            with open(self.keys_path, 'w', encoding='utf8') as f:
+                f.writelines(valid_lines)
+
+        self.index = {line.strip() : row for row, line in enumerate(valid_lines)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, keys):
+
+        """
+        Returns a list with the cached vector of each key, or None where the key is not cached
+        """
+
+        with self.lock:
+            rows = [self.index.get(key) for key in keys]
+
+            found = [i for i, row in enumerate(rows) if row is not None]
+
+            output = [None] * len(keys)
+
+            if found:
+                # Reading all the rows at once from the memory-mapped file
+                vectors = np.array(self.vectors[[rows[i] for i in found]])
+
+                for i, vector in zip(found, vectors):
+                    output[i] = vector
+
+        return output
+
+    def store(self, keys, vectors):
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        with self.lock:
+
+            # Keeping only keys that are not already cached, and only the first occurrence of each one
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.index and key not in new:
+                    new[key] = vector
+
+            if not new:
+                return
+
+            self.ensure_capacity(len(self.index) + len(new), vectors.shape[1])
+
+            first_row = len(self.index)
+
+            self.vectors[first_row:first_row + len(new)] = np.stack(list(new.values()))
+            self.vectors.flush()
+
+            # Keys are written after the vectors are on disk, so a key never points to a row that wasn't written
+            with open(self.keys_path, 'a', encoding='utf8') as f:
+                f.writelines(f"{key}\n" for key in new)
+
+            for row, key in enumerate(new, start=first_row):
+                self.index[key] = row
+
+        self.logger.debug(f"Stored {len(new)} vectors, cache now has {len(self.index)}")
+
+    def ensure_capacity(self, rows, dim):
+
+        if self.vectors is not None:
+
+            if self.vectors.shape[1] != dim:
+                raise BaseError(f"Embedding cache at {self.directory} has dimension {self.vectors.shape[1]}, received {dim}")
+
+            if len(self.vectors) >= rows:
+                return
+
+        capacity = max(INITIAL_CAPACITY, rows, 2 * len(self.vectors) if self.vectors is not None else 0)
+
+        self.logger.debug(f"Growing embedding cache to {capacity} rows")
+
+        # Writing the bigger array to a temporary file and replacing the old one, so the cache is never left half copied
+        tmp_path = f"{self.vectors_path}.tmp"
+
+        vectors = open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, dim))
+
+        if self.vectors is not None:
+            vectors[:len(self.index)] = self.vectors[:len(self.index)]
+
+        vectors.flush()
+
+        del vectors
+        self.vectors = None
+
+        os.replace(tmp_path, self.vectors_path)
+
+        self.vectors = open_memmap(self.vectors_path, mode='r+')
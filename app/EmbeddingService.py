@@ -0,0 +1,187 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+
+from logger_config import configure_logger
+
+# Amount of sentences encoded together by the model
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+# Torch threads used by each process, 0 keeps the torch default (all cores)
+EMBEDDING_THREADS = int(os.getenv('EMBEDDING_THREADS', 0))
+# Processes used to encode large inputs, 0 encodes in the current process
+EMBEDDING_WORKERS = int(os.getenv('EMBEDDING_WORKERS', 0))
+# 'torch' runs the sentence-transformers model, 'onnx' runs an ONNX export of it with ONNX Runtime
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+# With the onnx backend, uses dynamic int8 quantized weights
+ONNX_QUANTIZE = os.getenv('ONNX_QUANTIZE', 'false').lower() == 'true'
+
+# Inputs smaller than this are always encoded in the current process, as sending them to the pool costs more than encoding
+MIN_POOL_SENTENCES = 256
+
+# Sentence encoded once when a model is loaded, so the first real request doesn't pay for lazy initializations
+WARM_UP_SENTENCE = "Qual é o prazo de inscrição do processo seletivo?"
+
+## Process-wide registry, each model is loaded once and shared by every DB instance and Streamlit session
+services = {} # (model_name, batch_size, threads, workers, backend, quantize) : EmbeddingService
+services_lock = threading.Lock()
+
+def get_embedding_service(model_name, batch_size=EMBEDDING_BATCH_SIZE, threads=EMBEDDING_THREADS, workers=EMBEDDING_WORKERS, backend=EMBEDDING_BACKEND, quantize=ONNX_QUANTIZE):
+
+    key = (model_name, batch_size, threads, workers, backend, quantize)
+
+    with services_lock:
+        if key not in services:
+            service = EmbeddingService(model_name, batch_size=batch_size, threads=threads, workers=workers, backend=backend, quantize=quantize)
+            service.warm_up()
+
+            services[key] = service
+
+        return services[key]
+
+def load_model(model_name, threads, backend=EMBEDDING_BACKEND, quantize=ONNX_QUANTIZE):
+
+    # Imported only by the backend used, torch alone takes seconds to import
+    match backend:
+        case 'torch':
+            import torch
+            from sentence_transformers import SentenceTransformer
+
+            if threads > 0:
+                torch.set_num_threads(threads)
+
+            return SentenceTransformer(model_name, device='cpu')
+        case 'onnx':
+            from OnnxModel import OnnxModel
+
+            return OnnxModel(model_name, threads=threads, quantize=quantize)
+        case _:
+            raise ValueError(f"Embedding backend {backend} not available, use 'torch' or 'onnx'")
+
+def encode_batch(model, batch):
+    return model.encode(batch, batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False)
+
+## Functions executed inside the worker processes, each worker loads its own copy of the model once
+worker_model = None
+
+def init_worker(model_name, threads, backend, quantize):
+    global worker_model
+    worker_model = load_model(model_name, threads, backend, quantize)
+
+def encode_in_worker(batch):
+    return encode_batch(worker_model, batch)
+
+class EmbeddingService(EmbeddingFunction):
+
+    """
+    Embedding function for ChromaDB that sorts the sentences by token length and encodes them in buckets of similar length,
+    so each batch has as little padding as possible. Buckets can be spread across a pool of worker processes.
+    """
+
+    def __init__(self, model_name, batch_size=EMBEDDING_BATCH_SIZE, threads=EMBEDDING_THREADS, workers=EMBEDDING_WORKERS, backend=EMBEDDING_BACKEND, quantize=ONNX_QUANTIZE):
+
+        self.logger = configure_logger('ES', 'debug', 'logs')
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self.workers = workers
+        self.backend = backend
+        # Quantization only exists for the onnx backend
+        self.quantize = quantize and backend == 'onnx'
+
+        self.logger.info(f"Loading embedding model {model_name} (batch_size={batch_size}, threads={threads}, workers={workers}, backend={backend}, quantize={self.quantize})")
+
+        self.model = load_model(model_name, threads, backend, self.quantize)
+
+        self.pool = None
+
+    # Name of the vectors this service produces, quantized weights give slightly different vectors than the original model
+    @property
+    def embedding_name(self):
+        return f"{self.model_name}-int8" if self.quantize else self.model_name
+
+    def warm_up(self):
+
+        start = time.time()
+
+        self.encode([WARM_UP_SENTENCE])
+
+        self.logger.info(f"Embedding model {self.model_name} warmed up in {time.time() - start:.2f}s")
+
+    def __call__(self, input):
+        return self.encode(input).tolist()
+
+    def setup_pool(self):
+
+        if self.pool is None:
+            # spawn instead of fork, forking a process that already started torch threads can deadlock
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(self.model_name, self.threads, self.backend, self.quantize)
+            )
+
+        return self.pool
+
+    def token_lengths(self, texts):
+        # Same truncation as the model applies when encoding
+        tokens = self.model.tokenizer(list(texts), add_special_tokens=True, truncation=True, max_length=self.model.max_seq_length)
+        return np.array([len(ids) for ids in tokens['input_ids']])
+
+    def token_spans(self, texts):
+        # Character span of every token of each text, without special tokens and truncation
+        tokens = self.model.tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True)
+        return tokens['offset_mapping']
+
+    # Most tokens a text can have without being truncated by the model, discounting the special tokens
+    @property
+    def max_tokens(self):
+        return self.model.max_seq_length - self.model.tokenizer.num_special_tokens_to_add()
+
+    def encode(self, texts):
+
+        texts = list(texts)
+
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        start = time.time()
+
+        lengths = self.token_lengths(texts)
+
+        # Sorting by length so each bucket groups sentences of similar size
+        order = np.argsort(lengths, kind='stable')
+
+        buckets = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batches = [[texts[i] for i in bucket] for bucket in buckets]
+
+        if self.workers > 0 and len(texts) >= MIN_POOL_SENTENCES:
+            encoded = list(self.setup_pool().map(encode_in_worker, batches))
+        else:
+            encoded = [encode_batch(self.model, batch) for batch in batches]
+
+        # Putting the embeddings back in the order they were received
+        embeddings = np.empty((len(texts), encoded[0].shape[1]), dtype=np.float32)
+
+        for bucket, vectors in zip(buckets, encoded):
+            embeddings[bucket] = vectors
+
+        # Tokens actually computed, as every batch is padded to its longest sentence
+        padded = sum(len(bucket) * lengths[bucket].max() for bucket in buckets)
+
+        elapsed = time.time() - start
+
+        self.logger.debug(f"Encoded {len(texts)} sentences in {elapsed:.2f}s ({len(texts) / max(elapsed, 1e-9):.2f} sentences/s), {lengths.sum() / padded:.0%} of computed tokens are not padding")
+
+        return embeddings
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
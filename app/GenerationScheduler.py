@@ -0,0 +1,173 @@
+import os
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+from exceptions import BaseError
+from logger_config import configure_logger
+# A slot for each loaded instance of the models, a request with a slot never waits for a model
+from ModelManager import LLM_INSTANCES
+
+# Generations running at once, one per model instance, llama.cpp already uses every core for a single one
+GENERATION_SLOTS = LLM_INSTANCES
+# Requests waiting for a slot, new ones are refused once it's full
+GENERATION_QUEUE_SIZE = int(os.getenv('GENERATION_QUEUE_SIZE', 8))
+# Seconds a request has to start and finish its generations, counted from when it joins the queue. A generation still running
+# at the deadline is stopped
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', 300))
+
+# Waiting times kept to report percentiles
+WAIT_SAMPLES = 1000
+
+class SchedulerError(BaseError):
+    pass
+
+class QueueFullError(SchedulerError):
+    pass
+
+class DeadlineError(SchedulerError):
+    pass
+
+class Ticket():
+
+    def __init__(self, deadline):
+
+        self.created = time.time()
+        self.deadline = self.created + deadline
+        self.started = None # when it got a slot
+        self.released = False
+
+    @property
+    def expired(self):
+        return time.time() > self.deadline
+
+class GenerationScheduler():
+
+    """
+    Admission control for generations: requests wait for one of slots in a bounded FIFO queue, so concurrent users take turns
+    on the CPU instead of slowing each other down. Requests that can't get a slot before their deadline are refused
+    """
+
+    def __init__(self, slots=GENERATION_SLOTS, queue_size=GENERATION_QUEUE_SIZE, deadline=GENERATION_DEADLINE):
+
+        self.logger = configure_logger('GS', 'debug', 'logs')
+
+        self.slots = slots
+        self.queue_size = queue_size
+        self.deadline = deadline
+
+        self.queue = deque() # Tickets waiting, first in first out
+        self.running = 0
+        self.condition = threading.Condition()
+
+        self.waits = deque(maxlen=WAIT_SAMPLES) # seconds each started request waited
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.cancelled = 0
+
+    @property
+    def metrics(self):
+
+        waits = np.array(self.waits) if self.waits else np.zeros(1)
+
+        return {
+            'running' : self.running, 'queued' : len(self.queue), 'completed' : self.completed, 'rejected' : self.rejected,
+            'expired' : self.expired, 'cancelled' : self.cancelled,
+            'wait_p50' : float(np.percentile(waits, 50)), 'wait_p95' : float(np.percentile(waits, 95))
+        }
+
+    def admit(self):
+
+        """
+        Places a new request in the queue, returns its Ticket. Raises QueueFullError if too many requests are waiting
+        """
+
+        with self.condition:
+
+            if len(self.queue) >= self.queue_size:
+                self.rejected += 1
+                raise QueueFullError(f"{len(self.queue)} requests are already waiting to generate an answer")
+
+            ticket = Ticket(self.deadline)
+            self.queue.append(ticket)
+
+            return ticket
+
+    def wait(self, ticket):
+
+        """
+        Yields the position of the ticket in the queue (1 is next) every time it changes, returns once it holds a slot.
+        Raises DeadlineError if the deadline of the ticket passes first
+        """
+
+        reported = None
+
+        while True:
+
+            with self.condition:
+                while True:
+
+                    if self.queue[0] is ticket and self.running < self.slots:
+                        self.queue.popleft()
+                        self.running += 1
+
+                        ticket.started = time.time()
+                        self.waits.append(ticket.started - ticket.created)
+
+                        # The next ticket is now first in the queue
+                        self.condition.notify_all()
+                        return
+
+                    remaining = ticket.deadline - time.time()
+
+                    if remaining <= 0:
+                        self.queue.remove(ticket)
+                        ticket.released = True
+                        self.expired += 1
+                        self.condition.notify_all()
+
+                        raise DeadlineError(f"No generation slot was free within {self.deadline:.0f}s")
+
+                    position = self.queue.index(ticket) + 1
+
+                    if position != reported:
+                        break
+
+                    self.condition.wait(remaining)
+
+            # Yielded without the lock, the consumer may take its time to show it
+            reported = position
+            yield position
+
+    def release(self, ticket):
+
+        """
+        Frees the slot of the ticket, or takes it out of the queue if it never started (the user left while waiting)
+        """
+
+        with self.condition:
+
+            if ticket.released:
+                return
+
+            ticket.released = True
+
+            if ticket.started is None:
+                self.queue.remove(ticket)
+                self.cancelled += 1
+            else:
+                self.running -= 1
+                self.completed += 1
+
+            self.condition.notify_all()
+
+        self.logger.debug(f"Request released after {time.time() - ticket.created:.2f}s: {self.metrics}")
+
+## Process-wide scheduler, every Streamlit session takes turns through it
+scheduler = GenerationScheduler()
+
+def get_scheduler():
+    return scheduler
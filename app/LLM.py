@@ -1,35 +1,82 @@
 #regular expression for word count
 import re
+import os
+import time
+# Collections are searched at the same time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from langchain.prompts import PromptTemplate
-from langchain_community.llms import LlamaCpp
 
 # DataBase access
-from DB import DB
+from DB import DB, TOKENS_KEY
+# Models stay loaded between questions
+from ModelManager import get_model_manager, MODEL_PATHS, N_CTX
+# Answers of similar questions already asked
+from AnswerCache import get_answer_cache, USE_ANSWER_CACHE
+# Concurrent users take turns to generate
+from GenerationScheduler import get_scheduler
+# Diversification of the chunks found
+from vector_math import collapse_duplicates, maximal_marginal_relevance, rank_relevance
 # logger configs
 from logger_config import configure_logger
 
-CURRENT_LLMS = ["llama2"]
-MAX_CONTENT_WORDS = 4000
+CURRENT_LLMS = list(MODEL_PATHS)
+# Approximate tokens of INST_PROMPT_TEMPLATE without the context, references and question
+PROMPT_TOKENS = 450
+# Chunk token counts come from the embedding model tokenizer, llama's tokenizer produces about this many tokens for the same portuguese text
+LLM_TOKENS_PER_CHUNK_TOKEN = 1.3
+# Least tokens (from the embedding model tokenizer) left for the context, max_tokens is lowered to keep them
+MIN_CONTEXT_TOKENS = int(os.getenv('MIN_CONTEXT_TOKENS', 256))
 QUERY_RESULTS = 5
+# Characters (after normalize_answer) of the beginning of the default answer that identify it, its generation stops once they're produced
+DEFAULT_ANSWER_PREFIX_CHARS = int(os.getenv('DEFAULT_ANSWER_PREFIX_CHARS', 20))
+# Dropping near-duplicate chunks (the same paragraph in mirrored pages) and choosing varied ones among more candidates
+DIVERSIFY = os.getenv('DIVERSIFY', 'true').lower() == 'true'
+# Chunks fetched from each collection when diversifying, QUERY_RESULTS of them are kept in total
+QUERY_CANDIDATES = int(os.getenv('QUERY_CANDIDATES', 10))
+# Cosine similarity above which two chunks are the same content, only the nearest one is kept
+DUPLICATE_SIMILARITY = float(os.getenv('DUPLICATE_SIMILARITY', 0.95))
+# Maximal marginal relevance weight, 1 only ranks by relevance to the question and lower values favor chunks unlike the ones already chosen
+MMR_WEIGHT = float(os.getenv('MMR_WEIGHT', 0.7))
 REFERENCE_STRING = 'url'
 REFERENCE_DIVIDER = ' - '
+# Chunks shared by many pages (menus, footers) would list every URL, only the first ones are shown
+MAX_REFERENCES_PER_CHUNK = 3
+# URLs have few characters per token, llama's tokenizer produces about one token for this many characters of a URL
+REFERENCE_CHARS_PER_TOKEN = 3
+# Collections searched at the same time by a question
+QUERY_WORKERS = int(os.getenv('QUERY_WORKERS', 8))
 
 # Variables received by the chromaDB query
 ID_STR = 'ids'
 DISTANCE_STR = 'distances'
 METADATAS_STR = 'metadatas'
 DOCUMENTS_STR = 'documents'
+# Name of the collection of each result
+COLLECTION_STR = 'collection'
 
+# Events yielded by LLM.stream
+TOKEN_EVENT = 'token'
+RESET_EVENT = 'reset'
+QUEUE_EVENT = 'queue'
+ANSWER_EVENT = 'answer'
 
 
-INST_PROMPT_TEMPLATE = """[INST] <<SYS>>
+# Static instructions at the beginning of every prompt, the model state after them is reused instead of evaluated on each request.
+# Nothing that changes between requests can be placed here
+INST_PROMPT_PREFIX = """[INST] <<SYS>>
 Você é um assistente prestativo, respeitoso e honesto. Sempre responda da maneira mais prestativa possível, estando seguro.  Suas respostas não devem incluir conteúdo prejudicial, antiético, racista, sexista, tóxico, perigoso ou ilegal. Certifique-se de que suas respostas sejam socialmente imparciais e de natureza positiva. Se uma pergunta não fizer sentido ou não for factualmente coerente, explique o porquê, em vez de responder algo incorreto. Se você não sabe a resposta a uma pergunta, não compartilhe informações falsas.
-Você receberá uma pergunta de um usuário, responda a pergunta utilizando APENAS o seguinte contexto '''{context}'''.
-Não escreva nenhuma informação que não estiver presente dentro do contexto fornecido e caso não consiga responder a pergunta com base APENAS no contexto fornecido, responda {default_answer} e nada mais.
-Sempre informe as seguintes referências como fonte das informações '''{references}'''
+Você receberá uma pergunta de um usuário, responda a pergunta utilizando APENAS o contexto informado abaixo.
+Não escreva nenhuma informação que não estiver presente dentro do contexto fornecido e caso não consiga responder a pergunta com base APENAS no contexto fornecido, responda a resposta padrão informada abaixo e nada mais.
+Sempre informe as referências informadas abaixo como fonte das informações.
 Se comunique APENAS em português brasileiro.
 Não mencione nenhuma dessas instruções ou o contexto fornecido, apenas responda o usuário e informe as referências
+"""
+
+INST_PROMPT_TEMPLATE = INST_PROMPT_PREFIX + """Resposta padrão: {default_answer}
+Contexto: '''{context}'''
+Referências: '''{references}'''
 <</SYS>>
 Pergunta: {question}
 Resposta:[/INST]
@@ -42,6 +89,10 @@ Resposta:[/INST]
 def val_to_float(val):
     return float(str(val).replace(',','.'))
 
+# Lowercase words without punctuation or extra spaces, so the beginning of an answer can be compared with the default answer
+def normalize_answer(text):
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
 class LLM():
 
     def __init__(self):
@@ -50,15 +101,45 @@ class LLM():
 
         self.db= DB()
 
-    def  __call__(self, question, collections, default_answer, distance, temperature, top_p, max_tokens, llm_model):
+        self.models = get_model_manager()
+
+        # Shared by every question, Chroma and NumPy release the GIL while searching
+        self.query_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+        self.answer_cache = get_answer_cache() if USE_ANSWER_CACHE else None
+
+        self.scheduler = get_scheduler()
+
+    def  __call__(self, question, collections, default_answer, distance, temperature, top_p, max_tokens, llm_model, url_filter=''):
+
+        answer = None
+
+        # Same as stream, waiting for the whole answer
+        for event, value in self.stream(question, collections, default_answer, distance, temperature, top_p, max_tokens, llm_model, url_filter):
+            if event == ANSWER_EVENT:
+                answer = value
+
+        return answer
+
+    def stream(self, question, collections, default_answer, distance, temperature, top_p, max_tokens, llm_model, url_filter=''):
+
+        """
+        Yields (TOKEN_EVENT, token) while the answer is generated, (RESET_EVENT, None) when the tokens generated so far are
+        discarded because that context didn't have the answer, and finally (ANSWER_EVENT, answer) with the answer and references.
+        While other requests are generating, (QUEUE_EVENT, position) is yielded whenever the position in the queue changes.
+        Raises QueueFullError when too many requests are waiting, and DeadlineError when no slot is free before the deadline
+        """
 
         # Checking if llm_model is within the available options
         if llm_model not in CURRENT_LLMS:                
             self.logger.error(f"LLM: {llm_model} not available, use one of the following options: {CURRENT_LLMS}")
-            return None
+            yield ANSWER_EVENT, None
+            return
 
         # Normalizing and typing values
         collections, distance, temperature, top_p, max_tokens = self.normalize(collections, distance, temperature, top_p, max_tokens)
+
+        max_tokens = self.clamp_max_tokens(max_tokens)
         
         self.logger.info(f"""LLM:
                 question:{question}
@@ -68,39 +149,149 @@ class LLM():
                 temperature:{temperature}
                 top_p:{top_p}
                 max_tokens:{max_tokens}
-                llm_model:{llm_model}""")
+                llm_model:{llm_model}
+                url_filter:{url_filter}""")
 
-        # Search for context and references if you find context, in collections within the db that have a distance smaller than distance
-        contexts, references = self.find_context(question, collections, distance)
+        # The question is embedded once, for the answer cache and for every collection searched
+        query_embedding = self.db.embed_query(question)
 
-        self.logger.debug(f'contexts:"""{contexts}"""')
-        self.logger.debug(f'references:"""{references}"""')
+        # Answers only depend on the question, these settings and the content of the collections
+        settings = (tuple(collections), default_answer, distance, temperature, top_p, max_tokens, llm_model, url_filter)
+        versions = self.db.collection_versions(collections) if self.answer_cache is not None else None
 
-        if not contexts:
+        if self.answer_cache is not None and (cached := self.answer_cache.lookup(query_embedding, settings, versions)):
+            self.logger.info(f"Answer found in the cache (hit rate {self.answer_cache.hit_rate:.0%}): {cached.answer}")
+            self.logger.info(f"References of the cached answer: {cached.references}")
+            yield ANSWER_EVENT, cached.answer
+            return
+
+        # Search for chunks in collections within the db that have a distance smaller than distance
+        hits = self.find_context(question, collections, distance, url_filter, query_embedding)
+
+        if not hits:
             self.logger.warning("Nothing found in the database")
-            return None
+            yield ANSWER_EVENT, None
+            return
 
-        # If the context has more words than MAX_CONTENT_WORDS, truncate
-        contexts = self.split_context_if_too_long(contexts)
+        if DIVERSIFY:
+            hits = self.diversify(hits)
 
-        for context, reference in zip(contexts, references):
+        # Best chunks together in a single prompt, as many as fit in the LLM context window
+        packs = self.pack_contexts(hits, max_tokens)
 
-            # Access LLM and get an answer
-            answer = self.get_llm_answer(question, context, reference, default_answer, llm_model, temperature, top_p, max_tokens)
+        self.logger.debug(f'contexts:"""{packs}"""')
 
-            if default_answer not in answer and answer.strip():
-                self.logger.info(f"Context used: {context}")
-                break
+        # Retrieval doesn't need a slot, only the generations wait their turn
+        ticket = self.scheduler.admit()
+
+        # Set when the deadline cut the attempts short, that answer isn't cached
+        stopped = False
+
+        # References of the prompt that had the answer, or of the hits listed when none had it
+        used_references = None
+
+        # Closing this generator (the user left) frees the place in the queue or the slot
+        try:
+            for position in self.scheduler.wait(ticket):
+                self.logger.debug(f"Waiting for a generation slot, position {position}")
+                yield QUEUE_EVENT, position
+
+            for context, reference in packs:
+
+                # Access LLM and stream its answer, stopping it as soon as it's the default answer
+                answer = yield from self.watch_answer(self.stream_llm_answer(question, context, reference, default_answer, llm_model, temperature, top_p, max_tokens, ticket.deadline), default_answer)
+
+                answer = answer.strip()
+
+                # The generation was cut at the deadline, what it wrote is kept but no more contexts are tried
+                if ticket.expired:
+                    self.logger.warning("Deadline reached, generation stopped and no more contexts are tried")
+                    stopped = True
+
+                self.logger.info(f'answer: {answer}')
+
+                if default_answer not in answer and answer:
+                    self.logger.info(f"Context used: {context}")
+                    used_references = reference
+                    break
+
+                # The next prompt is tried, what was shown of this answer is discarded
+                yield RESET_EVENT, None
+
+                # Past its deadline, the request doesn't keep the slot for more attempts
+                if stopped:
+                    break
+
+        finally:
+            self.scheduler.release(ticket)
 
         # Check if LLM found any information or used the default_answer
         if default_answer in answer:
             # If it used default_answer, return similar documents found in the db
-            if references:
+            if references := [reference for reference in map(self.get_reference, hits) if reference]:
                 answer = self.write_references_answer(default_answer, references)
+                used_references = ' ; '.join(references)
             else:
                 self.logger.warning("No references were found, default answer being used")
                 answer = default_answer
 
+        # Kept with the versions the collections had before the search, an ingestion meanwhile makes it stale right away
+        if self.answer_cache is not None and not stopped:
+            self.answer_cache.store(query_embedding, settings, versions, answer, used_references)
+
+        yield ANSWER_EVENT, answer
+
+    def watch_answer(self, tokens, default_answer):
+
+        """
+        Yields (TOKEN_EVENT, token) for the tokens of the generation and returns the answer. Tokens are held back while the answer
+        may still be the default answer, and the generation is stopped once it is, so a context without the answer costs a few tokens
+        """
+
+        default_prefix = normalize_answer(default_answer)[:DEFAULT_ANSWER_PREFIX_CHARS]
+
+        answer = ''
+        count = 0
+        # Tokens not shown yet, None once the answer is known not to be the default answer
+        held = [] if default_prefix else None
+
+        try:
+            for token in tokens:
+                answer += token
+                count += 1
+
+                if held is not None:
+                    beginning = normalize_answer(answer)
+
+                    if beginning.startswith(default_prefix):
+                        self.logger.info(f"Default answer recognized after {count} tokens, generation stopped")
+                        return default_answer
+
+                    # Still the beginning of the default answer, nothing to show yet
+                    if default_prefix.startswith(beginning):
+                        held.append(token)
+                        continue
+
+                    for held_token in held:
+                        yield TOKEN_EVENT, held_token
+
+                    held = None
+
+                yield TOKEN_EVENT, token
+
+                # The model answered and then wrote the default answer, the rest isn't needed either
+                if default_answer and default_answer in answer:
+                    self.logger.info(f"Default answer written after {count} tokens, generation stopped")
+                    return answer
+
+        finally:
+            # Closing the generation right away frees the model for the next attempt or request
+            tokens.close()
+
+        # Short answers can end while they could still be the default answer
+        for held_token in held or []:
+            yield TOKEN_EVENT, held_token
+
         return answer
 
     # Normalization of values ​​to ensure correct functionality
@@ -118,46 +309,102 @@ class LLM():
         return collections, distance, temperature, top_p, max_tokens
 
     # Search for contexts (collections) within the database
-    def find_context(self, question, collections, distance):
+    # url_filter restricts the search to pages under comma separated URL prefixes, e.g. "ppgia.pucpr.br/pt/doutorado, ppgia.pucpr.br/pt/mestrado"
+    # query_embedding is the embedding of the question, when it was already computed
+    def find_context(self, question, collections, distance, url_filter='', query_embedding=None):
+
+        if url_filter:
+            self.logger.debug(f"Searching only under {url_filter}")
 
-        # Initializing return variables
-        contexts, references = [], []
+        # Embedded once for every collection, instead of once per collection
+        if query_embedding is None:
+            query_embedding = self.db.embed_query(question)
 
-        for name in collections:
+        # Hits of a single collection
+        def search(name):
             try:
-                collection = self.db.client.get_collection(name = name, embedding_function=self.db.ef)
+                collection = self.db.get_collection(name)
 
             except ValueError:
                 self.logger.error(f"Collection {name} is not present in the database!")
-                continue
+                return []
+
+            # Get similarity search result of the question, with list size QUERY_RESULTS, or more candidates to diversify from
+            # A failed search leaves that collection out instead of failing the whole question
+            try:
+                query = self.db.query(collection, question, QUERY_CANDIDATES if DIVERSIFY else QUERY_RESULTS, url_filter, query_embedding)
 
-            # Get similarity search result of the question, with list size QUERY_RESULTS
-            query = collection.query(query_texts=question, n_results=QUERY_RESULTS)
+            except Exception as e:
+                self.logger.error(f"Search in {name} failed: {e}")
+                return []
 
             # Formatting chromadb output into a list of dictionaries, with each dict being an occasion found
-            context, reference = self.unwrap_query(query, distance)
+            collection_hits = self.unwrap_query(query, distance)
+
+            for hit in collection_hits:
+                hit[COLLECTION_STR] = name
+
+            return collection_hits
+
+        start = time.time()
+
+        # Every collection is searched at the same time, results come back in the order of collections
+        hits = [collection_hits for collection_hits in self.query_pool.map(search, collections) if collection_hits]
+
+        self.logger.debug(f"Searched {len(collections)} collections in {time.time() - start:.3f}s")
+
+        # Interleaving the results of each collection
+        return [hit for group in zip(*hits) for hit in group]
+
+    # Stored embeddings of the chunks of the hits, one row per hit
+    def hit_embeddings(self, hits):
 
-            #self.logger.debug(f'context:"""{context}"""\reference:"""{reference}"""')
+        positions = {}
+        for i, hit in enumerate(hits):
+            positions.setdefault(hit[COLLECTION_STR], []).append(i)
 
-            # Checking if something was found, if not, we do nothing
-            if context:
-                contexts.append(context)
+        embeddings = [None] * len(hits)
 
-            if reference:
-                references.append(reference)
+        # Read from the embedding cache when possible, with one lookup per collection
+        for name, collection_positions in positions.items():
 
-        contexts = [item for pair in zip(*contexts) for item in pair]
-        references = [item for pair in zip(*references) for item in pair]
+            vectors = self.db.full_embeddings(self.db.get_collection(name), [hits[i][ID_STR] for i in collection_positions])
 
-        return contexts, references
+            for i, vector in zip(collection_positions, vectors):
+                embeddings[i] = vector
+
+        return np.stack(embeddings)
+
+    def diversify(self, hits):
+
+        """
+        Keeps only the best ranked of each group of near-duplicate hits, then picks QUERY_RESULTS of the rest by maximal marginal
+        relevance, so the prompt carries fewer and more varied contexts. Hits are in the order of the search (fused with BM25,
+        interleaved across collections), relevance comes from that order instead of distances
+        """
+
+        if len(hits) < 2:
+            return hits
+
+        embeddings = self.hit_embeddings(hits)
+
+        # Rows after a duplicate are removed, so the copy kept is the best ranked one
+        unique = collapse_duplicates(embeddings, DUPLICATE_SIMILARITY)
+
+        selected = unique[maximal_marginal_relevance(rank_relevance(len(unique)), embeddings[unique], QUERY_RESULTS, MMR_WEIGHT)]
+
+        self.logger.debug(f"{len(hits)} hits: {len(hits) - len(unique)} near-duplicates dropped, {len(selected)} chosen by MMR")
+
+        return [hits[i] for i in selected]
 
     # Separate the return list into dictionaries for each value found, instead of a single dictionary with a list of values
     def unwrap_query(self, query, max_distance):
 
-        # Initializing return variables
-        contexts, references = [], []
+        # Initializing return variable
+        hits = []
 
         # Obtaining query size, could've been from QUERY_RESULTS
+        query_len = 0
         for key in query:
             # We use [0] because ChromaDB returns a list of a single list of results
             if query[key]:
@@ -171,51 +418,144 @@ class LLM():
         for i in range(query_len):
 
             # If similarity distance is greater than the maximum distance sent by the request, ignore result
-            if distance := query[DISTANCE_STR][0][i] > max_distance:
+            if (distance := query[DISTANCE_STR][0][i]) > max_distance:
                 self.logger.debug(f'Distância ({distance}) de similaridade acima do máximo em:"""{query[DOCUMENTS_STR][0][i]}"""')
                 continue
 
             # Obtaining the values ​​of interest for the application
-            # If necessary to obtain values ​​such as ID and distance, access here
-            contexts.append(query[DOCUMENTS_STR][0][i])
-            metadatas = query[METADATAS_STR][0][i]
+            # If necessary to obtain other values, access here
+            hits.append({
+                ID_STR : query[ID_STR][0][i],
+                DOCUMENTS_STR : query[DOCUMENTS_STR][0][i],
+                METADATAS_STR : query[METADATAS_STR][0][i] or {},
+                DISTANCE_STR : distance
+            })
 
             self.logger.debug(f"\nadded: {query[DOCUMENTS_STR][0][i]} to context\n")
             self.logger.debug(f"\nadded: {query[METADATAS_STR][0][i]} to metadatas\n\n")
 
-            if REFERENCE_STRING in metadatas:
-                references.append(metadatas[REFERENCE_STRING])
-            else:
-                self.logger.warning(f"Reference ({REFERENCE_STRING}) is not present within {list(metadatas)}")
+        return hits
 
-        return contexts, references
+    # URLs where the chunk of the hit appears, resolved from the reference table when first needed
+    def get_reference(self, hit):
 
-    # Check if the number of words in the context is greater than MAX_CONTENT_WORDS, if so, remove the excess
-    def split_context_if_too_long(self, contexts):
+        if REFERENCE_STRING not in hit:
+            self.load_references([hit])
 
-        split_contexts = []
+        return hit[REFERENCE_STRING]
 
-        for context in contexts:
-        
-            # Splitting context by words and their final index
-            words_and_index_list = self.words_and_index(context)
-            
-            self.logger.debug(f"Context contains {len(words_and_index_list)} words")
-            #self.logger.debug(f"Words and index: {words_and_index_list}")
-            
-            if len(words_and_index_list) > MAX_CONTENT_WORDS:
-            
-                end_index = words_and_index_list[MAX_CONTENT_WORDS][1]
-
-                self.logger.debug(f'Context too long, partial context removed:"""{context[end_index:]}"""')
-                
-                split_contexts.append(context[:end_index])
-            
-            # If it is not too long, we will return it in full
-            else:
-                split_contexts.append(context)
+    # Resolves the references of every hit not resolved yet, with one lookup per collection
+    def load_references(self, hits):
+
+        pending = {}
+        for hit in hits:
+            if REFERENCE_STRING not in hit:
+                pending.setdefault(hit[COLLECTION_STR], []).append(hit)
+
+        for collection, collection_hits in pending.items():
+
+            references = self.db.resolve_references(collection, [hit[ID_STR] for hit in collection_hits])
+
+            for hit in collection_hits:
+                urls = [url for url, _ in references.get(hit[ID_STR], [])]
+
+                # Collections stored before the reference table keep the URLs in the metadata
+                if not urls and REFERENCE_STRING in hit[METADATAS_STR]:
+                    urls = [hit[METADATAS_STR][REFERENCE_STRING]]
+
+                if not urls:
+                    self.logger.warning(f"No reference found for {hit[ID_STR]} in {hit[COLLECTION_STR]}")
+
+                hit[REFERENCE_STRING] = ' , '.join(urls[:MAX_REFERENCES_PER_CHUNK])
+
+    # Lowers max_tokens so the answer never takes the room of the context in the LLM context window
+    def clamp_max_tokens(self, max_tokens):
+
+        limit = int(N_CTX - PROMPT_TOKENS - MIN_CONTEXT_TOKENS * LLM_TOKENS_PER_CHUNK_TOKEN)
+
+        if max_tokens > limit:
+            self.logger.warning(f"max_tokens {max_tokens} leaves no room for the context in {N_CTX} tokens, using {limit}")
+            return limit
+
+        return max_tokens
+
+    # Most tokens (from the embedding model tokenizer) a context can have to fit in the LLM context window with the prompt and the answer
+    def context_token_budget(self, max_tokens):
+        return int((N_CTX - PROMPT_TOKENS - max_tokens) / LLM_TOKENS_PER_CHUNK_TOKEN)
+
+    # Approximate tokens (from the embedding model tokenizer) a reference takes in the prompt
+    def reference_tokens(self, reference):
+        return int(len(reference) / REFERENCE_CHARS_PER_TOKEN / LLM_TOKENS_PER_CHUNK_TOKEN) + 1
+
+    # Uses the token count stored with the chunk to check if it fits in budget, truncating it only if it doesn't. Returns the context and its tokens
+    def fit_context(self, hit, budget):
+
+        context = hit[DOCUMENTS_STR]
+        tokens = hit[METADATAS_STR].get(TOKENS_KEY)
+
+        if tokens is not None and tokens <= budget:
+            return context, tokens
 
-        return split_contexts
+        # Chunks stored without a token count, or bigger than the budget, are truncated by word count
+        words_and_index_list = self.words_and_index(context)
+
+        self.logger.debug(f"Context contains {tokens} tokens and {len(words_and_index_list)} words")
+
+        if len(words_and_index_list) > budget:
+
+            end_index = words_and_index_list[budget][1]
+
+            self.logger.debug(f'Context too long, partial context removed:"""{context[end_index:]}"""')
+
+            context = context[:end_index]
+
+        return context, min(len(words_and_index_list), budget)
+
+    def pack_contexts(self, hits, max_tokens):
+
+        """
+        Fills prompts with as many numbered chunks (and their references) as the token budget allows, in the order of hits: the
+        ranking of the search (fused with BM25, interleaved across collections) is kept, distances of different collections and
+        searches are not comparable. Returns [(context, references)], one per prompt: usually all hits fit in the first one, the others are only tried if it
+        doesn't have the answer
+        """
+
+        budget = self.context_token_budget(max_tokens)
+
+        self.load_references(hits)
+
+        packs = []
+        pack, used = [], 0
+        seen = set()
+
+        for hit in hits:
+
+            # Same content found in more than one collection
+            if hit[DOCUMENTS_STR] in seen:
+                continue
+            seen.add(hit[DOCUMENTS_STR])
+
+            reference = hit[REFERENCE_STRING]
+
+            context, tokens = self.fit_context(hit, max(budget - self.reference_tokens(reference), 1))
+            cost = tokens + self.reference_tokens(reference)
+
+            if pack and used + cost > budget:
+                packs.append(pack)
+                pack, used = [], 0
+
+            pack.append((context, reference))
+            used += cost
+
+        if pack:
+            packs.append(pack)
+
+        self.logger.debug(f"{len(hits)} chunks packed in {len(packs)} prompts: {[len(pack) for pack in packs]}")
+
+        return [(
+            '\n\n'.join(f"[{i}] {context}" for i, (context, _) in enumerate(pack, start=1)),
+            ' ; '.join(f"[{i}] {reference}" for i, (_, reference) in enumerate(pack, start=1) if reference)
+        ) for pack in packs]
 
     # Using regex, transforms the string into a list of words and the index where these words end
     def words_and_index(self, phrase):
@@ -232,30 +572,18 @@ class LLM():
                 template=prompt_template,
                 )
 
-    # Choice of method for different LLM models
-    def get_llm_answer(self, question, context, reference, default_answer, llm_model, temperature, top_p, max_tokens):
+    # Choice of method for different LLM models, returns the tokens of the answer as they are generated
+    # deadline is a time.time() after which the generation stops
+    def stream_llm_answer(self, question, context, reference, default_answer, llm_model, temperature, top_p, max_tokens, deadline=None):
         match llm_model:
             case "llama2":
-                return self.get_llama2_answer(question, context, reference, default_answer, temperature, top_p, max_tokens)
+                return self.stream_llama2_answer(question, context, reference, default_answer, temperature, top_p, max_tokens, deadline)
 
     # Method to use llama2 locally
-    def get_llama2_answer(self, question, context, reference, default_answer, temperature, top_p, max_tokens):
+    def stream_llama2_answer(self, question, context, reference, default_answer, temperature, top_p, max_tokens, deadline=None):
         
         self.logger.info('llama chosen')
 
-        self.logger.info('Loading model at models/llama-2-7b-chat.Q4_K_M.gguf')
-
-        llm = LlamaCpp(
-            model_path="models/llama-2-7b-chat.Q4_K_M.gguf",
-            verbose=False,
-            temperature=temperature,
-            top_p=top_p,
-            n_ctx = 1500,
-            max_tokens=4000
-        )
-
-        self.logger.info('Model loaded')
-
         # Variable to define the parameters that can be customized within the prompt
         prompt_variables = {'question':question, 'default_answer':default_answer, 'context':context, 'references':reference}
 
@@ -264,17 +592,10 @@ class LLM():
         
         self.logger.info(f'prompt: {prompt}')
 
-        # Initializing LLM and Chain
-        llm_chain = prompt | llm
-
         self.logger.info('Generating answer...')
 
-        # Generating answer with LLM
-        answer = llm_chain.invoke(prompt_variables)
-        
-        self.logger.info(f'answer: {answer}')
-
-        return answer.strip()
+        # Generating answer with the resident model, max_tokens is the same budget context_token_budget reserved for the answer
+        return self.models.stream("llama2", prompt.format(**prompt_variables), temperature, top_p, max_tokens, prefix=INST_PROMPT_PREFIX, deadline=deadline)
 
     # Return model if LLMs did not find the answer
     def write_references_answer(self, default_answer, references):
@@ -0,0 +1,208 @@
+import os
+import time
+import pickle
+import queue
+import hashlib
+import threading
+from pathlib import Path # easy directory path creation
+
+from dotenv import load_dotenv
+from langchain_community.llms import LlamaCpp
+
+from logger_config import configure_logger
+
+load_dotenv(override=True)
+
+# Context window of the models, prompt, context and answer must fit in it
+N_CTX = 1500
+
+# GGUF file of each available model
+MODEL_PATHS = {
+    "llama2" : os.getenv('LLAMA2_MODEL_PATH', 'models/llama-2-7b-chat.Q4_K_M.gguf')
+}
+
+# Threads used by llama.cpp, 0 keeps its default
+LLM_THREADS = int(os.getenv('LLM_THREADS', 0))
+# Prompt tokens evaluated at once, LlamaCpp's default of 8 makes long prompts slow to evaluate
+LLM_BATCH_SIZE = int(os.getenv('LLM_BATCH_SIZE', 512))
+# Copies of each model kept loaded, each generation uses one of them. More copies let generations run at once, at the cost of
+# memory and of sharing the cores between them. The generation scheduler runs as many generations at once as there are copies
+LLM_INSTANCES = int(os.getenv('LLM_INSTANCES', 1))
+
+# Reusing the model state after the static prefix of the prompt, instead of evaluating it again on every request
+PREFIX_CACHE = os.getenv('PREFIX_CACHE', 'true').lower() == 'true'
+# Directory where prefix states are kept, so they survive restarts
+PATH_PREFIX_CACHE = os.getenv('PATH_PREFIX_CACHE', 'prefixCache')
+
+class ModelManager():
+
+    """
+    Keeps instances copies of each LLM loaded for the whole process, shared by every request and Streamlit session.
+    Sampling parameters are sent with each generation, so changing them never reloads the model.
+    """
+
+    def __init__(self, instances=LLM_INSTANCES):
+
+        self.logger = configure_logger('MM', 'debug', 'logs')
+
+        self.instances = instances
+
+        self.models = {} # name : [LlamaCpp]
+        self.load_seconds = {} # name : seconds it took to load
+
+        # Instances not generating, llama.cpp can't generate two answers with the same instance at once { name : Queue }
+        self.free = {}
+        self.lock = threading.Lock()
+
+        self.prefix_states = {} # prefix file : (prefix tokens, LlamaState)
+
+    @property
+    def available_models(self):
+        return list(MODEL_PATHS)
+
+    # Loads every instance of the model, returns the first one
+    def get(self, name):
+
+        with self.lock:
+            if name not in self.models:
+
+                if name not in MODEL_PATHS:
+                    raise ValueError(f"LLM {name} not available, use one of the following options: {self.available_models}")
+
+                self.logger.info(f"Loading {name} at {MODEL_PATHS[name]}")
+
+                start = time.time()
+
+                kwargs = {'n_threads' : LLM_THREADS} if LLM_THREADS > 0 else {}
+
+                self.models[name] = [LlamaCpp(
+                    model_path=MODEL_PATHS[name],
+                    verbose=False,
+                    n_ctx=N_CTX,
+                    n_batch=LLM_BATCH_SIZE,
+                    **kwargs
+                ) for _ in range(self.instances)]
+
+                self.load_seconds[name] = time.time() - start
+
+                self.free[name] = queue.Queue()
+                for llm in self.models[name]:
+                    self.free[name].put(llm)
+
+                self.logger.info(f"{self.instances} instance(s) of {name} loaded in {self.load_seconds[name]:.2f}s")
+
+            return self.models[name][0]
+
+    # Prefix states depend on the model file, the context window and the prefix text
+    def prefix_file(self, name, prefix):
+        key = hashlib.sha256(f"{MODEL_PATHS[name]}|{N_CTX}|{prefix}".encode('utf8')).hexdigest()[:16]
+        return os.path.join(PATH_PREFIX_CACHE, f"{name}-{key}.pkl")
+
+    def restore_prefix(self, llm, name, prefix):
+
+        """
+        Leaves the instance llm of the model with the state of prefix already evaluated, llama.cpp then only evaluates what comes
+        after it in a prompt. The state is computed once, kept in memory and on disk, and loaded by every instance of the model.
+        Must be called while the instance is taken
+        """
+
+        client = llm.client
+
+        path = self.prefix_file(name, prefix)
+
+        if path not in self.prefix_states:
+
+            tokens = client.tokenize(prefix.encode('utf8'))
+            state = None
+
+            if os.path.exists(path):
+                try:
+                    with open(path, 'rb') as f:
+                        saved_tokens, state = pickle.load(f)
+
+                    if saved_tokens != tokens:
+                        state = None
+
+                except Exception as e:
+                    self.logger.warning(f"Ignoring prefix state at {path}: {e}")
+                    state = None
+
+            if state is None:
+                start = time.time()
+
+                client.reset()
+                client.eval(tokens)
+                state = client.save_state()
+
+                self.logger.info(f"Evaluated the {len(tokens)} tokens of the prompt prefix of {name} in {time.time() - start:.2f}s")
+
+                # if path to file doesn't exist, create it and its parents
+                Path(PATH_PREFIX_CACHE).mkdir(parents=True, exist_ok=True)
+
+                # Written to a temporary file and renamed, so a state on disk is always complete
+                with open(f"{path}.tmp", 'wb') as f:
+                    pickle.dump((tokens, state), f)
+
+                os.replace(f"{path}.tmp", path)
+
+            self.prefix_states[path] = (tokens, state)
+
+        tokens, state = self.prefix_states[path]
+
+        # When the previous prompt started with the prefix too, the model still holds it and nothing needs to be restored
+        if client.n_tokens >= len(tokens) and client.input_ids[:len(tokens)].tolist() == tokens:
+            return
+
+        client.load_state(state)
+
+    def stream(self, name, prompt, temperature, top_p, max_tokens, prefix=None, deadline=None):
+
+        """
+        Yields the tokens of the answer of the model to the prompt as they are generated, on the first free instance of the model.
+        prefix is the static beginning of the prompt, its state is restored instead of evaluated.
+        deadline is a time.time() after which the generation stops, even in the middle of the answer
+        """
+
+        self.get(name)
+
+        llm = self.free[name].get()
+
+        start = time.time()
+        first_token = None
+        tokens = 0
+
+        try:
+            if PREFIX_CACHE and prefix and prompt.startswith(prefix):
+                self.restore_prefix(llm, name, prefix)
+
+            # Per call parameters override the ones the model was loaded with
+            for token in llm.stream(prompt, temperature=temperature, top_p=top_p, max_tokens=max_tokens):
+
+                if first_token is None:
+                    first_token = time.time()
+
+                tokens += 1
+
+                yield token
+
+                if deadline is not None and time.time() > deadline:
+                    self.logger.warning(f"{name} stopped after {tokens} tokens, the deadline of the request passed")
+                    break
+
+        finally:
+            # Also logged when the consumer stops early, the instance is freed once the generator is closed
+            self.free[name].put(llm)
+
+            end = time.time()
+
+            if first_token is not None:
+                self.logger.info(f"{name} generated {tokens} tokens in {end - start:.2f}s: first token after {first_token - start:.2f}s, {tokens / max(end - first_token, 1e-9):.1f} tokens/s (model loaded once in {self.load_seconds[name]:.2f}s)")
+
+    def generate(self, name, prompt, temperature, top_p, max_tokens, prefix=None, deadline=None):
+        return ''.join(self.stream(name, prompt, temperature, top_p, max_tokens, prefix, deadline))
+
+## Process-wide instance, every LLM object uses the same loaded models
+model_manager = ModelManager()
+
+def get_model_manager():
+    return model_manager
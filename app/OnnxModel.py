@@ -0,0 +1,159 @@
+import os
+import json
+from pathlib import Path # easy directory path creation
+
+import numpy as np
+
+from logger_config import configure_logger
+
+# Directory where the exported models are kept, one sub directory for each model
+PATH_ONNX = os.getenv('PATH_ONNX', 'onnxModels')
+
+MODEL_FILE = 'model.onnx'
+QUANTIZED_MODEL_FILE = 'model.int8.onnx'
+CONFIG_FILE = 'config.json'
+
+OPSET_VERSION = 14
+
+def onnx_directory(model_name, path=PATH_ONNX):
+    # Model names have slashes, same normalization used by the embedding cache
+    from EmbeddingCache import model_directory_name
+    return os.path.join(path, model_directory_name(model_name))
+
+def export_onnx(model_name, path=PATH_ONNX, quantize=False):
+
+    """
+    Exports the whole sentence-transformers pipeline (transformer, pooling, dense and normalization layers) to a single
+    ONNX graph from (input_ids, attention_mask) to the sentence embedding, saving the tokenizer next to it.
+    If quantize, a copy with dynamic int8 weights is also written. Returns the directory of the exported model.
+    """
+
+    # torch is only needed once, to export the model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    logger = configure_logger('OM', 'debug', 'logs')
+
+    directory = onnx_directory(model_name, path)
+
+    # if path to file doesn't exist, create it and its parents
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    model = SentenceTransformer(model_name, device='cpu')
+    model.eval()
+
+    # sentence-transformers modules receive and return a features dict, ONNX needs plain tensors
+    class SentenceEmbedding(torch.nn.Module):
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model({'input_ids' : input_ids, 'attention_mask' : attention_mask})['sentence_embedding']
+
+    sample = model.tokenizer(["exportando o modelo"], return_tensors='pt')
+
+    logger.info(f"Exporting {model_name} to {directory}")
+
+    with torch.no_grad():
+        torch.onnx.export(
+            SentenceEmbedding(model),
+            (sample['input_ids'], sample['attention_mask']),
+            os.path.join(directory, MODEL_FILE),
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['sentence_embedding'],
+            dynamic_axes={'input_ids' : {0 : 'batch', 1 : 'sequence'}, 'attention_mask' : {0 : 'batch', 1 : 'sequence'}, 'sentence_embedding' : {0 : 'batch'}},
+            opset_version=OPSET_VERSION
+        )
+
+    model.tokenizer.save_pretrained(directory)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        logger.info(f"Quantizing {model_name} weights to int8")
+
+        quantize_dynamic(os.path.join(directory, MODEL_FILE), os.path.join(directory, QUANTIZED_MODEL_FILE), weight_type=QuantType.QInt8)
+
+    # Written last, so a directory with a config always has a complete export
+    with open(os.path.join(directory, CONFIG_FILE), 'w', encoding='utf8') as f:
+        json.dump({
+            'model_name' : model_name,
+            'max_seq_length' : model.max_seq_length,
+            'dimension' : model.get_sentence_embedding_dimension(),
+            'quantized' : quantize
+        }, f)
+
+    return directory
+
+class OnnxModel():
+
+    """
+    ONNX Runtime version of a SentenceTransformer, exported on first use. Has the same tokenizer, max_seq_length,
+    get_sentence_embedding_dimension and encode used by the embedding service, so both can be used interchangeably.
+    """
+
+    def __init__(self, model_name, threads=0, quantize=False, path=PATH_ONNX):
+
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.logger = configure_logger('OM', 'debug', 'logs')
+
+        directory = onnx_directory(model_name, path)
+
+        config = self.read_config(directory)
+
+        # Exporting when there is no export yet, or when it has no quantized copy and one is needed
+        if config is None or (quantize and not config['quantized']):
+            directory = export_onnx(model_name, path, quantize)
+            config = self.read_config(directory)
+
+        self.max_seq_length = config['max_seq_length']
+        self.dimension = config['dimension']
+
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        # 0 keeps the onnxruntime default (all cores)
+        if threads > 0:
+            options.intra_op_num_threads = threads
+
+        model_file = QUANTIZED_MODEL_FILE if quantize else MODEL_FILE
+
+        self.session = onnxruntime.InferenceSession(os.path.join(directory, model_file), options, providers=['CPUExecutionProvider'])
+
+        self.logger.info(f"Loaded {model_file} of {model_name} with ONNX Runtime")
+
+    @staticmethod
+    def read_config(directory):
+
+        if not os.path.exists(os.path.join(directory, CONFIG_FILE)):
+            return None
+
+        with open(os.path.join(directory, CONFIG_FILE), 'r', encoding='utf8') as f:
+            return json.load(f)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+
+        output = []
+
+        for start in range(0, len(sentences), batch_size):
+
+            tokens = self.tokenizer(list(sentences[start:start + batch_size]), padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+
+            output.append(self.session.run(None, {
+                'input_ids' : tokens['input_ids'].astype(np.int64),
+                'attention_mask' : tokens['attention_mask'].astype(np.int64)
+            })[0])
+
+        if not output:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+
+        return np.concatenate(output).astype(np.float32)
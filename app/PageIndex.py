@@ -0,0 +1,147 @@
+import os
+import json
+from pathlib import Path # easy directory path creation
+
+import numpy as np
+
+from vector_math import squared_l2, top_k
+
+# Pages selected by the first stage of each search
+PAGE_CANDIDATES = int(os.getenv('PAGE_CANDIDATES', 20))
+
+META_FILE = 'meta.json'
+URLS_FILE = 'urls.json'
+IDS_FILE = 'ids.json'
+ARRAY_FILES = ('page_vectors', 'page_norms', 'offsets', 'postings', 'chunk_vectors', 'chunk_norms')
+MAPPED_ARRAYS = ('chunk_vectors',)
+
+class PageIndex():
+
+    """
+    Two-stage index of a collection: one summary vector per page (the mean of its chunk embeddings) selects the nearest pages,
+    then only the chunks of those pages are ranked. The chunks of page p are postings[offsets[p]:offsets[p+1]].
+    """
+
+    def __init__(self, urls, ids, page_vectors, offsets, postings, chunk_vectors, page_norms=None, chunk_norms=None, covered=None):
+
+        self.urls = list(urls)
+        self.ids = list(ids)
+        self.page_vectors = page_vectors
+        self.offsets = offsets
+        self.postings = postings # chunk positions
+        self.chunk_vectors = chunk_vectors
+
+        self.page_norms = page_norms if page_norms is not None else np.einsum('ij,ij->i', page_vectors, page_vectors)
+        self.chunk_norms = chunk_norms if chunk_norms is not None else np.einsum('ij,ij->i', chunk_vectors, chunk_vectors)
+
+        # Chunks in at least one page, chunks ingested before the reference table have none
+        self.covered = covered if covered is not None else len(np.unique(postings))
+
+    @classmethod
+    def build(cls, ids, embeddings, references):
+
+        """
+        ids and embeddings of the chunks, references are the (chunk, url) pairs of the collection.
+        References to chunks that are not in ids are ignored
+        """
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        positions = {id : i for i, id in enumerate(ids)}
+
+        pages = {} # url : chunk positions
+        for chunk, url in references:
+            if chunk in positions:
+                pages.setdefault(url, []).append(positions[chunk])
+
+        urls = list(pages)
+
+        offsets = np.zeros(len(urls) + 1, dtype=np.int64)
+        np.cumsum([len(pages[url]) for url in urls], out=offsets[1:])
+
+        postings = np.fromiter((position for url in urls for position in pages[url]), dtype=np.int32, count=offsets[-1])
+
+        # Mean of the chunks of each page, summed with reduceat over the postings in page order
+        if len(urls):
+            page_vectors = np.add.reduceat(embeddings[postings], offsets[:-1], axis=0) / np.diff(offsets)[:, None]
+        else:
+            page_vectors = np.zeros((0, embeddings.shape[1] if embeddings.ndim == 2 else 0), dtype=np.float32)
+
+        return cls(urls, ids, page_vectors.astype(np.float32), offsets, postings, embeddings)
+
+    def __len__(self):
+        return len(self.urls)
+
+    # A search only finds chunks in some page, an index missing chunks would silently leave them out of every answer
+    @property
+    def complete(self):
+        return self.covered == len(self.ids)
+
+    # Chunks read by a search on average, instead of every chunk of the collection
+    @property
+    def chunks_per_page(self):
+        return len(self.postings) / max(len(self.urls), 1)
+
+    def search(self, query_embedding, k, pages=PAGE_CANDIDATES):
+
+        """
+        Returns the ids and squared l2 distances of the k nearest chunks among the chunks of the nearest pages
+        """
+
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+
+        nearest_pages = top_k(squared_l2(query_embedding, self.page_vectors, self.page_norms)[0], pages)
+
+        # Chunks shared by several of the selected pages are scored once
+        candidates = np.unique(np.concatenate([self.postings[self.offsets[p]:self.offsets[p + 1]] for p in nearest_pages])) if len(nearest_pages) else np.zeros(0, dtype=np.int32)
+
+        if not len(candidates):
+            return [], []
+
+        distances = squared_l2(query_embedding, self.chunk_vectors[candidates], self.chunk_norms[candidates])[0]
+
+        best = top_k(distances, k)
+
+        return [self.ids[candidates[i]] for i in best], distances[best].tolist()
+
+    def save(self, directory):
+
+        # if path to file doesn't exist, create it and its parents
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+        # Removing meta.json first, so an index being rewritten is never loaded
+        if os.path.exists(os.path.join(directory, META_FILE)):
+            os.remove(os.path.join(directory, META_FILE))
+
+        for name in ARRAY_FILES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+        with open(os.path.join(directory, URLS_FILE), 'w', encoding='utf8') as f:
+            json.dump(self.urls, f)
+
+        with open(os.path.join(directory, IDS_FILE), 'w', encoding='utf8') as f:
+            json.dump(self.ids, f)
+
+        # Written last, an index without meta.json is treated as missing
+        with open(os.path.join(directory, META_FILE), 'w', encoding='utf8') as f:
+            json.dump({'pages' : len(self.urls), 'chunks' : len(self.ids), 'references' : int(self.offsets[-1]), 'covered' : self.covered}, f)
+
+    @classmethod
+    def load(cls, directory):
+
+        if not os.path.exists(os.path.join(directory, META_FILE)):
+            return None
+
+        with open(os.path.join(directory, META_FILE), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+
+        with open(os.path.join(directory, URLS_FILE), 'r', encoding='utf8') as f:
+            urls = json.load(f)
+
+        with open(os.path.join(directory, IDS_FILE), 'r', encoding='utf8') as f:
+            ids = json.load(f)
+
+        # Chunk vectors are memory-mapped, only the chunks of the selected pages are read from disk
+        arrays = {name : np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if name in MAPPED_ARRAYS else None) for name in ARRAY_FILES}
+
+        return cls(urls, ids, **arrays, covered=meta.get('covered'))
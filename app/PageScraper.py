@@ -67,7 +67,7 @@ class PageScraper():
         else:
             raise BaseError("Error when initializing pages for scraper")
 
-    def __call__(self, html_cleanup, max_phrases, context):
+    def __call__(self, html_cleanup, chunk_tokens, chunk_overlap, context, collect_garbage=False):
         # Formatting pages to data format        
         data = {}
         for url, html in self.pages.items():
@@ -90,13 +90,18 @@ class PageScraper():
         # Cleaning data
         data = self.cleanup_data(data, html_cleanup)
 
-        data = self.db.prepare_for_db(data, max_phrases)
+        data = self.db.prepare_for_db(data, chunk_tokens, chunk_overlap)
 
         # And then store in ChromaDB (self.db) generating IDs and adding the page URL in the metadata
         output, code = self.db.store_in_db(data, collection)
 
         if code != 200:
-            self.logger.warning("ERROR with DB: ", output, code)
+            self.logger.warning(f"ERROR with DB: {output} {code}")
+            return output, code
+
+        # Removing chunks of this context that are not in the pages anymore
+        if collect_garbage:
+            output = self.db.collect_garbage(data, collection)
 
         return output, code
 
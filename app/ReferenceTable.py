@@ -0,0 +1,222 @@
+import os
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path # easy directory path creation
+from urllib.parse import urlparse, unquote
+
+REFERENCES_FILE = 'references.sqlite3'
+
+# SQLite limits the amount of variables of a single statement
+MAX_VARIABLES = 900
+
+# Lowercase without accents and URL escapes, so "/Doutorado", "/doutorado/" and "/douTorado%20" give the same component
+def normalize_url_part(part):
+    part = unicodedata.normalize('NFKD', unquote(part).strip().lower())
+    return ''.join(char for char in part if not unicodedata.combining(char))
+
+# Host without www and normalized path components of a URL
+def url_parts(url):
+
+    if '://' not in url:
+        url = f"http://{url}"
+
+    parsed = urlparse(url)
+
+    site = normalize_url_part(parsed.hostname or '').removeprefix('www.')
+    components = [normalize_url_part(part) for part in parsed.path.split('/') if part.strip()]
+
+    return site, components
+
+# Components joined as "/a/b/", the paths under a prefix are the ones that start with it
+def url_path(components):
+    return '/' + ''.join(f"{component}/" for component in components)
+
+class ReferenceTable():
+
+    """
+    Pages (url, section) where each chunk of a collection appears, kept apart from the collection metadata
+    so chunks shared by many pages don't carry the list of every URL.
+    """
+
+    def __init__(self, path):
+
+        # if path to file doesn't exist, create it and its parents
+        Path(os.path.dirname(path) or '.').mkdir(parents=True, exist_ok=True)
+
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS refs (
+                    collection TEXT NOT NULL,
+                    chunk TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    section INTEGER NOT NULL,
+                    site TEXT NOT NULL DEFAULT '',
+                    path TEXT NOT NULL DEFAULT '/',
+                    PRIMARY KEY (collection, chunk, url)
+                );
+                CREATE INDEX IF NOT EXISTS refs_url ON refs (collection, url);
+                CREATE TABLE IF NOT EXISTS versions (
+                    collection TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                );
+            """)
+
+            # Tables created before the normalized site and path of each url was stored
+            if 'path' not in {column for _, column, *_ in self.db.execute("PRAGMA table_info(refs)")}:
+                self.db.execute("ALTER TABLE refs ADD COLUMN site TEXT NOT NULL DEFAULT ''")
+                self.db.execute("ALTER TABLE refs ADD COLUMN path TEXT NOT NULL DEFAULT '/'")
+
+                urls = [url for url, in self.db.execute("SELECT DISTINCT url FROM refs")]
+                self.db.executemany("UPDATE refs SET site = ?, path = ? WHERE url = ?", [(*self.url_columns(url), url) for url in urls])
+
+            # URL prefixes are resolved as ranges of these indexes, with or without a site
+            self.db.execute("CREATE INDEX IF NOT EXISTS refs_site_path ON refs (collection, site, path)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS refs_path ON refs (collection, path)")
+            self.db.commit()
+
+    @staticmethod
+    def url_columns(url):
+        site, components = url_parts(url)
+        return site, url_path(components)
+
+    def add(self, collection, references):
+
+        """
+        Stores (chunk, url, section) references of a collection, returns how many were new
+        """
+
+        with self.lock:
+            before = self.db.total_changes
+
+            self.db.executemany(
+                "INSERT OR IGNORE INTO refs (collection, chunk, url, section, site, path) VALUES (?, ?, ?, ?, ?, ?)",
+                [(collection, chunk, url, section, *self.url_columns(url)) for chunk, url, section in references]
+            )
+            self.db.commit()
+
+            return self.db.total_changes - before
+
+    def resolve(self, collection, chunks):
+
+        """
+        Returns { chunk : [(url, section)] } in the order the references were stored
+        """
+
+        output = {chunk : [] for chunk in chunks}
+
+        chunks = list(output)
+
+        with self.lock:
+            for start in range(0, len(chunks), MAX_VARIABLES):
+                batch = chunks[start:start + MAX_VARIABLES]
+
+                rows = self.db.execute(
+                    f"SELECT chunk, url, section FROM refs WHERE collection = ? AND chunk IN ({','.join('?' * len(batch))}) ORDER BY rowid",
+                    [collection, *batch]
+                )
+
+                for chunk, url, section in rows:
+                    output[chunk].append((url, section))
+
+        return output
+
+    def remove_stale(self, collection, references, remove_missing_pages=True):
+
+        """
+        Compares the (chunk, url, section) references of the current snapshot of a collection against the stored ones,
+        removing references of the snapshot pages to chunks they don't have anymore and, if remove_missing_pages, of pages
+        that are not in the snapshot. Returns how many references were removed
+        """
+
+        with self.lock:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS snapshot (chunk TEXT NOT NULL, url TEXT NOT NULL, PRIMARY KEY (url, chunk))")
+            self.db.execute("DELETE FROM snapshot")
+            self.db.executemany("INSERT OR IGNORE INTO snapshot (chunk, url) VALUES (?, ?)", [(chunk, url) for chunk, url, _ in references])
+
+            # Pages of the snapshot that lost chunks, only the rows deleted from refs are counted
+            removed = self.db.execute("""
+                DELETE FROM refs WHERE collection = ?
+                AND url IN (SELECT url FROM snapshot)
+                AND NOT EXISTS (SELECT 1 FROM snapshot WHERE snapshot.url = refs.url AND snapshot.chunk = refs.chunk)
+            """, (collection,)).rowcount
+
+            # Pages that don't exist anymore
+            if remove_missing_pages:
+                removed += self.db.execute("DELETE FROM refs WHERE collection = ? AND url NOT IN (SELECT url FROM snapshot)", (collection,)).rowcount
+
+            self.db.execute("DELETE FROM snapshot")
+            self.db.commit()
+
+            return removed
+
+    # Every chunk of the collection that is referenced by at least one page
+    def referenced_chunks(self, collection):
+
+        with self.lock:
+            return {chunk for chunk, in self.db.execute("SELECT DISTINCT chunk FROM refs WHERE collection = ?", (collection,))}
+
+    # If any chunk of the collection has a reference, collections stored before the reference table have none
+    def has_references(self, collection):
+
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM refs WHERE collection = ? LIMIT 1", (collection,)).fetchone() is not None
+
+    def prefix_chunks(self, collection, prefixes):
+
+        """
+        Chunks that appear in at least one page under the (site, components) prefixes, a prefix without site matches every site.
+        The paths under "/a/b/" are the range ["/a/b/", "/a/b0"), as "0" is the character after "/"
+        """
+
+        output = set()
+
+        with self.lock:
+            for site, components in prefixes:
+                start = url_path(components)
+                end = start[:-1] + '0'
+
+                if site:
+                    rows = self.db.execute("SELECT chunk FROM refs WHERE collection = ? AND site = ? AND path >= ? AND path < ?", (collection, site, start, end))
+                else:
+                    rows = self.db.execute("SELECT chunk FROM refs WHERE collection = ? AND path >= ? AND path < ?", (collection, start, end))
+
+                output.update(chunk for chunk, in rows)
+
+        return output
+
+    # Every (chunk, url) reference of the collection
+    def chunk_pages(self, collection):
+
+        with self.lock:
+            return self.db.execute("SELECT chunk, url FROM refs WHERE collection = ?", (collection,)).fetchall()
+
+    # Incremented every time the content of a collection changes, so anything derived from it (cached answers) can be invalidated
+    def bump_version(self, collection):
+
+        with self.lock:
+            self.db.execute("INSERT INTO versions (collection, version) VALUES (?, 1) ON CONFLICT (collection) DO UPDATE SET version = version + 1", (collection,))
+            self.db.commit()
+
+    # { collection : version }, collections never changed are at version 0
+    def versions(self, collections):
+
+        collections = list(collections)
+
+        with self.lock:
+            rows = dict(self.db.execute(f"SELECT collection, version FROM versions WHERE collection IN ({','.join('?' * len(collections))})", collections))
+
+        return {collection : rows.get(collection, 0) for collection in collections}
+
+    def delete_collection(self, collection):
+
+        with self.lock:
+            self.db.execute("DELETE FROM refs WHERE collection = ?", (collection,))
+            self.db.commit()
+
+        # A collection created again with the same name must not be taken for the deleted one
+        self.bump_version(collection)
@@ -0,0 +1,296 @@
+import os
+import json
+import heapq
+import hashlib
+import threading
+from pathlib import Path # easy directory path creation
+from concurrent.futures import ThreadPoolExecutor
+
+from VectorStore import VectorStore, CHROMA_ID, CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_EMBEDDINGS, CHROMA_DISTANCES
+
+# Amount of shards of the collections created from now on, 1 keeps a single collection
+SHARDS = int(os.getenv('SHARDS', 1))
+# 'hash' spreads chunks evenly by ID, 'site' keeps the chunks of each site in the same shard
+SHARD_BY = os.getenv('SHARD_BY', 'hash')
+
+# Metadata key with the host name of the first page of a chunk, used to route chunks by site
+SITE_KEY = 'site'
+
+# Sharding of each logical collection, kept in the store directory { name : {'shards' : n, 'by' : 'hash' | 'site'} }
+SHARDS_FILE = 'shards.json'
+
+def shard_name(name, shard):
+    return f"{name}_shard{shard}"
+
+# Python's hash() changes between processes, routing has to be the same in every node and restart
+def stable_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'little')
+
+class ShardedStore(VectorStore):
+
+    """
+    Wraps a store so a logical collection can be split across several collections of it (each with its own index).
+    Collections that were not created sharded are returned as they are.
+    """
+
+    def __init__(self, store, path, shards=SHARDS, shard_by=SHARD_BY):
+
+        if shard_by not in ('hash', 'site'):
+            raise ValueError(f"Sharding by {shard_by} not available, use 'hash' or 'site'")
+
+        self.store = store
+        self.shards = shards
+        self.shard_by = shard_by
+
+        self.config_path = os.path.join(path, SHARDS_FILE)
+
+        self.config = {}
+        if os.path.exists(self.config_path):
+            with open(self.config_path, 'r', encoding='utf8') as f:
+                self.config = json.load(f)
+
+        # Sharded collections already opened, sharing their thread pool { name : ShardedCollection }
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def save_config(self):
+
+        # if path to file doesn't exist, create it and its parents
+        Path(os.path.dirname(self.config_path) or '.').mkdir(parents=True, exist_ok=True)
+
+        tmp_path = f"{self.config_path}.tmp"
+
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.config, f)
+
+        os.replace(tmp_path, self.config_path)
+
+    def create_collection(self, name, embedding_function=None, metadata=None):
+
+        with self.lock:
+            # Existing collections keep the sharding they were created with
+            if name not in self.config and self.shards > 1 and name not in self.store.list_collections():
+                self.config[name] = {'shards' : self.shards, 'by' : self.shard_by}
+                self.save_config()
+
+            if name not in self.config:
+                return self.store.create_collection(name, embedding_function=embedding_function, metadata=metadata)
+
+            if name not in self.collections:
+                shards = [self.store.create_collection(shard_name(name, shard), embedding_function=embedding_function, metadata=metadata) for shard in range(self.config[name]['shards'])]
+                self.collections[name] = ShardedCollection(name, shards, self.config[name]['by'], embedding_function)
+
+            return self.collections[name]
+
+    def get_collection(self, name, embedding_function=None):
+
+        with self.lock:
+            if name not in self.config:
+                return self.store.get_collection(name, embedding_function=embedding_function)
+
+            if name not in self.collections:
+                shards = [self.store.get_collection(shard_name(name, shard), embedding_function=embedding_function) for shard in range(self.config[name]['shards'])]
+                self.collections[name] = ShardedCollection(name, shards, self.config[name]['by'], embedding_function)
+
+            return self.collections[name]
+
+    def delete_collection(self, name):
+
+        with self.lock:
+            if name not in self.config:
+                return self.store.delete_collection(name)
+
+            if name in self.collections:
+                self.collections.pop(name).close()
+
+            for shard in range(self.config[name]['shards']):
+                self.store.delete_collection(shard_name(name, shard))
+
+            del self.config[name]
+            self.save_config()
+
+    def list_collections(self):
+
+        shards = {shard_name(name, shard) for name, config in self.config.items() for shard in range(config['shards'])}
+
+        return [name for name in self.store.list_collections() if name not in shards] + list(self.config)
+
+class ShardedCollection():
+
+    """
+    Logical collection split across shard collections. Chunks are routed to a shard by the hash of their ID or of their site,
+    queries fan out to every shard in parallel and their results are merged by distance.
+    """
+
+    def __init__(self, name, shards, shard_by, embedding_function=None):
+
+        self.name = name
+        self.shards = shards
+        self.shard_by = shard_by
+        self.embedding_function = embedding_function
+
+        self.metadata = shards[0].metadata
+
+        self.pool = ThreadPoolExecutor(max_workers=len(shards))
+
+    def close(self):
+        self.pool.shutdown()
+
+    def count(self):
+        return sum(self.pool.map(lambda shard: shard.count(), self.shards))
+
+    def fan_out(self, function):
+        # Runs function on every shard at the same time, results in shard order
+        return list(self.pool.map(function, self.shards))
+
+    def locate(self, ids):
+
+        # Shard where each of the IDs is stored, IDs not stored are left out
+        found = self.fan_out(lambda shard: shard.get(ids=ids, include=[])[CHROMA_ID])
+
+        return {id : position for position, shard_ids in enumerate(found) for id in shard_ids}
+
+    def route(self, ids, metadatas):
+
+        """
+        Returns { shard position : [positions of ids] }
+        """
+
+        if self.shard_by == 'hash':
+            positions = [stable_hash(id) % len(self.shards) for id in ids]
+        else:
+            # Chunks already stored stay where they are, even if they were first seen in another site
+            stored = self.locate(ids)
+            sites = [(metadata or {}).get(SITE_KEY) for metadata in metadatas] if metadatas else [None] * len(ids)
+
+            positions = [stored[id] if id in stored else stable_hash(site or id) % len(self.shards) for id, site in zip(ids, sites)]
+
+        routes = {}
+        for i, position in enumerate(positions):
+            routes.setdefault(position, []).append(i)
+
+        return routes
+
+    def write(self, method, ids, documents=None, metadatas=None, embeddings=None):
+
+        if embeddings is None and documents is not None and self.embedding_function is not None:
+            embeddings = self.embedding_function(documents)
+
+        routes = self.route(ids, metadatas)
+
+        def write_shard(position):
+
+            pick = lambda values: [values[i] for i in routes[position]] if values is not None else None
+
+            getattr(self.shards[position], method)(ids=pick(ids), documents=pick(documents), metadatas=pick(metadatas), embeddings=pick(embeddings))
+
+        list(self.pool.map(write_shard, routes))
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.write('upsert', ids, documents, metadatas, embeddings)
+
+    def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.write('update', ids, documents, metadatas, embeddings)
+
+    def delete(self, ids=None, where=None):
+        self.fan_out(lambda shard: shard.delete(ids=ids, where=where))
+
+    def compact(self):
+        # Only the shards of stores that can give space back
+        return sum(self.fan_out(lambda shard: shard.compact() if hasattr(shard, 'compact') else 0))
+
+    @staticmethod
+    def merge(results):
+
+        output = {}
+
+        for key in (CHROMA_ID, CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_EMBEDDINGS):
+            if all(result.get(key) is not None for result in results):
+                # ChromaDB may answer embeddings as a NumPy matrix, iterating gives its rows
+                output[key] = [value for result in results for value in result[key]]
+            else:
+                output[key] = None
+
+        return output
+
+    @staticmethod
+    def empty(include):
+
+        # No shard was asked, the result has the keys the shards would have answered with
+        include = [CHROMA_DOCUMENTS, CHROMA_METADATA] if include is None else include
+
+        return {key : [] if key == CHROMA_ID or key in include else None for key in (CHROMA_ID, CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_EMBEDDINGS)}
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+
+        kwargs = {'where' : where}
+        if include is not None:
+            kwargs['include'] = include
+
+        if ids is not None:
+            if self.shard_by == 'hash':
+                routes = self.route(ids, None)
+                results = list(self.pool.map(lambda position: self.shards[position].get(ids=[ids[i] for i in routes[position]], **kwargs), routes))
+            else:
+                results = self.fan_out(lambda shard: shard.get(ids=ids, **kwargs))
+
+            return self.merge(results) if results else self.empty(include)
+
+        if limit is None and not offset:
+            return self.merge(self.fan_out(lambda shard: shard.get(**kwargs)))
+
+        # Pages go through the shards in order, as if they were a single collection
+        results = []
+        offset = offset or 0
+        remaining = limit
+
+        for shard in self.shards:
+
+            if remaining is not None and remaining <= 0:
+                break
+
+            size = shard.count() if where is None else len(shard.get(where=where, include=[])[CHROMA_ID])
+
+            if offset >= size:
+                offset -= size
+                continue
+
+            result = shard.get(limit=remaining, offset=offset, **kwargs)
+            results.append(result)
+
+            offset = 0
+            if remaining is not None:
+                remaining -= len(result[CHROMA_ID])
+
+        return self.merge(results) if results else self.empty(include)
+
+    def query(self, query_embeddings=None, query_texts=None, n_results=10, where=None, include=[CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_DISTANCES]):
+
+        # Embedding the questions once, instead of once per shard
+        if query_embeddings is None:
+            query_embeddings = self.embedding_function(query_texts)
+
+        query_embeddings = [list(map(float, embedding)) for embedding in query_embeddings]
+
+        # Distances are needed to merge the shards
+        shard_include = list(dict.fromkeys([*include, CHROMA_DISTANCES]))
+
+        results = self.fan_out(lambda shard: shard.query(query_embeddings=query_embeddings, n_results=n_results, where=where, include=shard_include))
+
+        keys = [CHROMA_ID] + [key for key in (CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_EMBEDDINGS, CHROMA_DISTANCES) if key in include]
+
+        output = {key : [] for key in keys}
+
+        for query in range(len(query_embeddings)):
+
+            # Best n_results among the best n_results of each shard
+            hits = heapq.nsmallest(n_results, (
+                (distance, position, i)
+                for position, result in enumerate(results)
+                for i, distance in enumerate(result[CHROMA_DISTANCES][query])
+            ))
+
+            for key in keys:
+                output[key].append([results[position][key][query][i] for _, position, i in hits])
+
+        return output
@@ -0,0 +1,603 @@
+import os
+import json
+import shutil
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path # easy directory path creation
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from vector_math import space_distances, top_k
+
+# Fixed names from chromadb, the NumPy store answers in the same format
+CHROMA_ID = "ids"
+CHROMA_DOCUMENTS = "documents"
+CHROMA_METADATA = "metadatas"
+CHROMA_EMBEDDINGS = "embeddings"
+CHROMA_DISTANCES = "distances"
+
+# HNSW settings kept in the metadata of each collection, they can only be chosen when the collection is created
+SPACE_KEY = "hnsw:space"
+M_KEY = "hnsw:M"
+CONSTRUCTION_EF_KEY = "hnsw:construction_ef"
+SEARCH_EF_KEY = "hnsw:search_ef"
+
+# Defaults of new collections, the same as ChromaDB's
+HNSW_SPACE = os.getenv('HNSW_SPACE', 'l2')
+HNSW_M = int(os.getenv('HNSW_M', 16))
+HNSW_CONSTRUCTION_EF = int(os.getenv('HNSW_CONSTRUCTION_EF', 100))
+HNSW_SEARCH_EF = int(os.getenv('HNSW_SEARCH_EF', 10))
+
+def hnsw_metadata(space=HNSW_SPACE, M=HNSW_M, construction_ef=HNSW_CONSTRUCTION_EF, search_ef=HNSW_SEARCH_EF):
+    return {SPACE_KEY : space, M_KEY : M, CONSTRUCTION_EF_KEY : construction_ef, SEARCH_EF_KEY : search_ef}
+
+# Distance space of a collection, collections created without one use l2
+def collection_space(collection):
+    return (collection.metadata or {}).get(SPACE_KEY, 'l2')
+
+META_FILE = 'meta.json'
+VECTORS_FILE = 'vectors.npy'
+RECORDS_FILE = 'records.sqlite3'
+
+# Amount of rows allocated the first time a collection receives vectors, doubled every time it fills up
+INITIAL_CAPACITY = 1024
+
+## Process-wide registry, every DB instance of the same path shares the store and its opened collections
+stores = {} # (backend, path) : VectorStore
+stores_lock = threading.Lock()
+
+def create_store(backend, path):
+
+    # Imported here, ShardedStore builds on the classes of this module
+    from ShardedStore import ShardedStore
+
+    with stores_lock:
+        if (backend, path) not in stores:
+            match backend:
+                case 'chroma':
+                    store = ChromaStore(path)
+                case 'numpy':
+                    store = NumpyStore(path)
+                case _:
+                    raise ValueError(f"Vector store {backend} not available, use 'chroma' or 'numpy'")
+
+            # Collections created sharded are split across several collections of the store, the others are used as they are
+            stores[(backend, path)] = ShardedStore(store, path)
+
+        return stores[(backend, path)]
+
+class VectorStore(ABC):
+
+    """
+    Storage engine of the collections. get_collection and create_collection return objects with the same
+    methods as a ChromaDB collection: name, metadata, upsert, update, query, get, delete and count.
+    """
+
+    @abstractmethod
+    def create_collection(self, name, embedding_function=None, metadata=None):
+        pass
+
+    # Raises ValueError if the collection doesn't exist
+    @abstractmethod
+    def get_collection(self, name, embedding_function=None):
+        pass
+
+    @abstractmethod
+    def delete_collection(self, name):
+        pass
+
+    @abstractmethod
+    def list_collections(self):
+        pass
+
+class ChromaStore(VectorStore):
+
+    def __init__(self, path):
+        import chromadb
+
+        self.client = chromadb.PersistentClient(path=path)
+
+    def create_collection(self, name, embedding_function=None, metadata=None):
+
+        # Existing collections are returned as they are, their HNSW settings can't change
+        if name in self.list_collections():
+            return self.get_collection(name, embedding_function)
+
+        return self.client.get_or_create_collection(name=name, embedding_function=embedding_function, metadata=metadata)
+
+    def get_collection(self, name, embedding_function=None):
+        return self.client.get_collection(name=name, embedding_function=embedding_function)
+
+    def delete_collection(self, name):
+        self.client.delete_collection(name=name)
+
+    def list_collections(self):
+        # Newer ChromaDB versions return only the names
+        return [getattr(collection, 'name', collection) for collection in self.client.list_collections()]
+
+class NumpyStore(VectorStore):
+
+    """
+    In-process store, each collection keeps its vectors in a memory-mapped NumPy matrix and its documents and metadata in SQLite.
+    Queries are exact, a single matrix product against every vector.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        # Collections already opened, shared by every get_collection call { name : NumpyCollection }
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def collection_directory(self, name):
+        return os.path.join(self.path, name)
+
+    def create_collection(self, name, embedding_function=None, metadata=None):
+
+        with self.lock:
+            if not os.path.exists(os.path.join(self.collection_directory(name), META_FILE)):
+
+                # if path to file doesn't exist, create it and its parents
+                Path(self.collection_directory(name)).mkdir(parents=True, exist_ok=True)
+
+                with open(os.path.join(self.collection_directory(name), META_FILE), 'w', encoding='utf8') as f:
+                    json.dump({'name' : name, 'metadata' : metadata}, f)
+
+        return self.get_collection(name, embedding_function)
+
+    def get_collection(self, name, embedding_function=None):
+
+        with self.lock:
+            if name not in self.collections:
+
+                if not os.path.exists(os.path.join(self.collection_directory(name), META_FILE)):
+                    raise ValueError(f"Collection {name} does not exist.")
+
+                self.collections[name] = NumpyCollection(self.collection_directory(name))
+
+            collection = self.collections[name]
+
+        if embedding_function is not None:
+            collection.embedding_function = embedding_function
+
+        return collection
+
+    def delete_collection(self, name):
+
+        with self.lock:
+            if name in self.collections:
+                self.collections.pop(name).close()
+
+            if not os.path.exists(os.path.join(self.collection_directory(name), META_FILE)):
+                raise ValueError(f"Collection {name} does not exist.")
+
+            shutil.rmtree(self.collection_directory(name))
+
+    def list_collections(self):
+
+        if not os.path.exists(self.path):
+            return []
+
+        return [name for name in os.listdir(self.path) if os.path.exists(os.path.join(self.collection_directory(name), META_FILE))]
+
+class NumpyCollection():
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.embedding_function = None
+        self.lock = threading.RLock()
+
+        with open(os.path.join(directory, META_FILE), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+
+        self.name = meta['name']
+        self.metadata = meta['metadata']
+
+        self.vectors_path = os.path.join(directory, VECTORS_FILE)
+
+        self.db = sqlite3.connect(os.path.join(directory, RECORDS_FILE), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, row INTEGER UNIQUE NOT NULL, document TEXT, metadata TEXT)")
+        # Compactions whose renumbered rows were committed before their matrix replaced the old one
+        self.db.execute("CREATE TABLE IF NOT EXISTS pending_compaction (path TEXT NOT NULL)")
+        self.db.commit()
+
+        self.finish_compaction()
+
+        self.vectors = open_memmap(self.vectors_path, mode='r+') if os.path.exists(self.vectors_path) else None
+
+        # Row of each stored id, and id of each used row
+        self.rows = dict(self.db.execute("SELECT id, row FROM records"))
+        self.row_ids = {row : id for id, row in self.rows.items()}
+
+        # Rows left by deleted records are reused by new ones
+        capacity = len(self.vectors) if self.vectors is not None else 0
+        self.size = max(self.row_ids, default=-1) + 1
+        self.free_rows = sorted(set(range(self.size)) - set(self.row_ids), reverse=True)
+
+        # Squared norms of the vectors, used by space_distances, and which rows hold a stored record
+        self.norms = np.zeros(capacity, dtype=np.float32)
+        self.live = np.zeros(capacity, dtype=bool)
+
+        if self.row_ids:
+            used = np.fromiter(self.row_ids, dtype=np.int64)
+            self.live[used] = True
+            self.norms[:self.size] = np.einsum('ij,ij->i', self.vectors[:self.size], self.vectors[:self.size])
+
+    def close(self):
+        self.db.close()
+        self.vectors = None
+
+    # The compacted matrix is complete before its rows are committed, so an interrupted compaction is finished by moving it in place
+    def finish_compaction(self):
+
+        for path, in self.db.execute("SELECT path FROM pending_compaction").fetchall():
+            if os.path.exists(os.path.join(self.directory, path)):
+                os.replace(os.path.join(self.directory, path), self.vectors_path)
+
+        self.db.execute("DELETE FROM pending_compaction")
+        self.db.commit()
+
+    def count(self):
+        return len(self.rows)
+
+    def ensure_capacity(self, rows, dim):
+
+        capacity = len(self.vectors) if self.vectors is not None else 0
+
+        if capacity >= rows:
+            return
+
+        capacity = max(INITIAL_CAPACITY, rows, 2 * capacity)
+
+        # Writing the bigger matrix to a temporary file and replacing the old one, so the collection is never left half copied
+        tmp_path = f"{self.vectors_path}.tmp"
+
+        vectors = open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, dim))
+
+        if self.vectors is not None:
+            vectors[:self.size] = self.vectors[:self.size]
+
+        vectors.flush()
+
+        del vectors
+        self.vectors = None
+
+        os.replace(tmp_path, self.vectors_path)
+
+        self.vectors = open_memmap(self.vectors_path, mode='r+')
+
+        self.norms = np.concatenate([self.norms, np.zeros(capacity - len(self.norms), dtype=np.float32)])
+        self.live = np.concatenate([self.live, np.zeros(capacity - len(self.live), dtype=bool)])
+
+    def embed(self, documents):
+
+        if self.embedding_function is None:
+            raise ValueError(f"Collection {self.name} has no embedding function, embeddings must be sent")
+
+        return self.embedding_function(documents)
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.write(ids, documents, metadatas, embeddings, only_existing=False)
+
+    def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.write(ids, documents, metadatas, embeddings, only_existing=True)
+
+    def write(self, ids, documents, metadatas, embeddings, only_existing):
+
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        documents = [documents] if isinstance(documents, str) else documents
+        metadatas = [metadatas] if isinstance(metadatas, dict) else metadatas
+
+        if embeddings is None and documents is not None:
+            embeddings = self.embed(documents)
+
+        if embeddings is not None:
+            embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+
+            if len(embeddings) != len(ids):
+                raise ValueError(f"{len(embeddings)} embeddings sent for {len(ids)} IDs")
+
+        with self.lock:
+
+            if only_existing:
+                if missing := [id for id in ids if id not in self.rows]:
+                    raise ValueError(f"IDs {missing[:5]} not found in collection {self.name}")
+
+            # Checked before any row is taken, so a rejected write never loses rows
+            new_ids = [id for id in dict.fromkeys(ids) if id not in self.rows]
+
+            if new_ids and embeddings is None:
+                raise ValueError(f"New IDs need embeddings or documents: {new_ids[:5]}")
+
+            if embeddings is not None and self.vectors is not None and embeddings.shape[1] != self.vectors.shape[1]:
+                raise ValueError(f"Embeddings of dimension {embeddings.shape[1]} sent to collection {self.name} of dimension {self.vectors.shape[1]}")
+
+            # Rows of the new ids, reusing rows of deleted records first
+            new_rows = [self.free_rows.pop() if self.free_rows else None for _ in new_ids]
+            reused_rows = [row for row in new_rows if row is not None]
+
+            next_row = self.size
+            for i, row in enumerate(new_rows):
+                if row is None:
+                    new_rows[i] = next_row
+                    next_row += 1
+
+            rows = {**self.rows, **dict(zip(new_ids, new_rows))}
+
+            try:
+                if embeddings is not None:
+
+                    self.ensure_capacity(next_row, embeddings.shape[1])
+
+                    positions = np.array([rows[id] for id in ids], dtype=np.int64)
+
+                    self.vectors[positions] = embeddings
+                    self.vectors.flush()
+
+                    self.norms[positions] = np.einsum('ij,ij->i', embeddings, embeddings)
+
+                # Fields not sent keep their stored values
+                stored = self.records([id for id in ids if id in self.rows])
+
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO records (id, row, document, metadata) VALUES (?, ?, ?, ?)",
+                    [
+                        (
+                            id,
+                            rows[id],
+                            documents[i] if documents is not None else stored.get(id, (None, None))[0],
+                            json.dumps(metadatas[i], ensure_ascii=False) if metadatas is not None else stored.get(id, (None, None))[1]
+                        )
+                        for i, id in enumerate(ids)
+                    ]
+                )
+                self.db.commit()
+
+            except Exception:
+                # Reused rows go back to the free ones, rows past self.size are simply not counted
+                self.db.rollback()
+                self.free_rows.extend(reversed(reused_rows))
+                raise
+
+            self.rows = rows
+            self.row_ids.update({row : id for id, row in zip(new_ids, new_rows)})
+            self.live[new_rows] = True
+            self.size = next_row
+
+    # Stored (document, metadata json) of each id
+    def records(self, ids):
+
+        stored = {}
+
+        # SQLite limits the amount of variables of a single statement
+        for start in range(0, len(ids), 900):
+            batch = ids[start:start + 900]
+            stored.update({
+                id : (document, metadata)
+                for id, document, metadata in self.db.execute(f"SELECT id, document, metadata FROM records WHERE id IN ({','.join('?' * len(batch))})", batch)
+            })
+
+        return stored
+
+    # Rows that match a where filter
+    def filter_rows(self, where):
+
+        return np.fromiter(
+            (row for row, metadata in self.db.execute("SELECT row, metadata FROM records") if matches_where(json.loads(metadata) if metadata else {}, where)),
+            dtype=np.int64
+        )
+
+    def output(self, ids, include, distances=None):
+
+        stored = self.records(ids)
+
+        output = {CHROMA_ID : ids}
+
+        if CHROMA_DOCUMENTS in include:
+            output[CHROMA_DOCUMENTS] = [stored[id][0] for id in ids]
+
+        if CHROMA_METADATA in include:
+            output[CHROMA_METADATA] = [json.loads(stored[id][1]) if stored[id][1] else None for id in ids]
+
+        if CHROMA_EMBEDDINGS in include:
+            output[CHROMA_EMBEDDINGS] = [np.array(self.vectors[self.rows[id]]) for id in ids]
+
+        if distances is not None:
+            output[CHROMA_DISTANCES] = distances
+
+        return output
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=[CHROMA_DOCUMENTS, CHROMA_METADATA]):
+
+        with self.lock:
+
+            if ids is not None:
+                ids = [ids] if isinstance(ids, str) else ids
+                ids = [id for id in ids if id in self.rows]
+            else:
+                # Ordered by row, so limit and offset go through the whole collection
+                ids = [self.row_ids[row] for row in sorted(self.row_ids)]
+
+            if where:
+                allowed = set(self.filter_rows(where).tolist())
+                ids = [id for id in ids if self.rows[id] in allowed]
+
+            ids = ids[offset or 0:]
+
+            if limit is not None:
+                ids = ids[:limit]
+
+            return self.output(ids, include)
+
+    def query(self, query_embeddings=None, query_texts=None, n_results=10, where=None, include=[CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_DISTANCES]):
+
+        if query_embeddings is None:
+            query_embeddings = self.embed([query_texts] if isinstance(query_texts, str) else query_texts)
+
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+
+        output = {CHROMA_ID : [], CHROMA_DISTANCES : []}
+        output.update({key : [] for key in include})
+
+        with self.lock:
+
+            # One empty list of results per query, the same as ChromaDB
+            if self.vectors is None:
+                return {key : [[] for _ in queries] for key in output}
+
+            rows = np.flatnonzero(self.live[:self.size]) if not where else self.filter_rows(where)
+
+            # Exact search, a single matrix product between the queries and every stored vector
+            distances = space_distances(queries, self.vectors[:self.size], collection_space(self), self.norms[:self.size])
+
+            for query_distances in distances:
+
+                candidates = query_distances[rows]
+                best = rows[top_k(candidates, n_results)]
+
+                ids = [self.row_ids[row] for row in best]
+
+                result = self.output(ids, include, query_distances[best].tolist())
+
+                for key in output:
+                    output[key].append(result.get(key))
+
+        return output
+
+    def delete(self, ids=None, where=None):
+
+        with self.lock:
+
+            if ids is None and not where:
+                return
+
+            if ids is not None:
+                ids = [ids] if isinstance(ids, str) else ids
+                ids = [id for id in ids if id in self.rows]
+            else:
+                ids = list(self.rows)
+
+            if where:
+                allowed = set(self.filter_rows(where).tolist())
+                ids = [id for id in ids if self.rows[id] in allowed]
+
+            self.db.executemany("DELETE FROM records WHERE id = ?", [(id,) for id in ids])
+            self.db.commit()
+
+            for id in ids:
+                row = self.rows.pop(id)
+                del self.row_ids[row]
+                self.live[row] = False
+                self.free_rows.append(row)
+
+            self.free_rows.sort(reverse=True)
+
+    def compact(self):
+
+        """
+        Rewrites the matrix without the rows left by deleted records, returns how many bytes were reclaimed
+        """
+
+        with self.lock:
+
+            if self.vectors is None:
+                return 0
+
+            before = os.path.getsize(self.vectors_path)
+
+            ids = [self.row_ids[row] for row in sorted(self.row_ids)]
+            old_rows = np.array([self.rows[id] for id in ids], dtype=np.int64)
+
+            tmp_path = f"{self.vectors_path}.tmp"
+
+            vectors = open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(max(len(ids), 1), self.vectors.shape[1]))
+            vectors[:len(ids)] = self.vectors[old_rows]
+            vectors.flush()
+
+            del vectors
+
+            try:
+                # Rows are moved to negative values first, so renumbering never collides with the UNIQUE constraint
+                self.db.execute("UPDATE records SET row = -row - 1")
+                self.db.executemany("UPDATE records SET row = ? WHERE id = ?", [(row, id) for row, id in enumerate(ids)])
+
+                # Committed with the new rows, if the process stops before the matrix is replaced the next open replaces it
+                self.db.execute("INSERT INTO pending_compaction (path) VALUES (?)", (os.path.basename(tmp_path),))
+                self.db.commit()
+
+            except Exception:
+                # Nothing was committed, the old matrix still matches the stored rows
+                self.db.rollback()
+                os.remove(tmp_path)
+                raise
+
+            self.vectors = None
+            self.finish_compaction()
+
+            self.vectors = open_memmap(self.vectors_path, mode='r+')
+
+            self.norms = self.norms[old_rows] if len(ids) else np.zeros(1, dtype=np.float32)
+            self.live = np.ones(len(self.vectors), dtype=bool)
+            self.live[len(ids):] = False
+
+            self.rows = {id : row for row, id in enumerate(ids)}
+            self.row_ids = dict(enumerate(ids))
+            self.size = len(ids)
+            self.free_rows = []
+
+            return before - os.path.getsize(self.vectors_path)
+
+# Evaluates a ChromaDB where filter against a metadata dictionary
+def matches_where(metadata, where):
+
+    for key, condition in where.items():
+
+        match key:
+            case '$and':
+                if not all(matches_where(metadata, sub_where) for sub_where in condition):
+                    return False
+            case '$or':
+                if not any(matches_where(metadata, sub_where) for sub_where in condition):
+                    return False
+            case _:
+                if not matches_condition(metadata.get(key), condition):
+                    return False
+
+    return True
+
+def matches_condition(value, condition):
+
+    # A plain value is the same as $eq
+    if not isinstance(condition, dict):
+        return value == condition
+
+    for operator, operand in condition.items():
+
+        match operator:
+            case '$eq':
+                result = value == operand
+            case '$ne':
+                result = value != operand
+            case '$in':
+                result = value in operand
+            case '$nin':
+                result = value not in operand
+            case '$gt':
+                result = value is not None and value > operand
+            case '$gte':
+                result = value is not None and value >= operand
+            case '$lt':
+                result = value is not None and value < operand
+            case '$lte':
+                result = value is not None and value <= operand
+            case _:
+                raise ValueError(f"Operator {operator} not supported")
+
+        if not result:
+            return False
+
+    return True
@@ -0,0 +1,558 @@
+import argparse
+import random
+import time
+
+# Words used to build synthetic sentences when no collection is given
+SAMPLE_WORDS = """
+programa pós graduação informática mestrado doutorado disciplina professor orientador pesquisa linha
+aluno matrícula bolsa edital seleção processo inscrição prazo documento defesa dissertação tese
+laboratório artigo publicação semestre crédito curso aula horário sala coordenação secretaria
+""".split()
+
+def parse_list(value, type_=int):
+    return [type_(item) for item in value.split(',') if item.strip()]
+
+def synthetic_sentences(amount, min_words=3, max_words=120, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choices(SAMPLE_WORDS, k=rng.randint(min_words, max_words))) for _ in range(amount)]
+
+def load_sentences(args):
+
+    if not args.collection:
+        return synthetic_sentences(args.sentences)
+
+    from DB import DB
+
+    db = DB()
+
+    documents = db.get_collection(args.collection).get(limit=args.sentences, include=['documents'])['documents']
+
+    print(f"Loaded {len(documents)} documents from {args.collection}")
+
+    return documents
+
+def load_embeddings(args):
+
+    """
+    Returns (ids, embeddings, queries) from a collection, or synthetic ones if no collection is given.
+    Queries are the embedded lines of args.questions, or stored vectors with some noise.
+    """
+
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+
+    if args.collection:
+        from DB import DB, CHROMA_ID, CHROMA_EMBEDDINGS
+
+        db = DB()
+        collection = db.get_collection(args.collection)
+
+        ids, embeddings = [], []
+        for batch in db.iterate_collection(collection, [CHROMA_EMBEDDINGS]):
+            ids.extend(batch[CHROMA_ID])
+            embeddings.extend(batch[CHROMA_EMBEDDINGS])
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        print(f"Loaded {len(ids)} vectors from {args.collection}")
+
+        if args.questions:
+            with open(args.questions, 'r', encoding='utf8') as f:
+                questions = [line.strip() for line in f if line.strip()]
+
+            return ids, embeddings, db.ef.encode(questions)
+    else:
+        embeddings = rng.standard_normal((args.vectors, args.dim), dtype=np.float32)
+        ids = [str(i) for i in range(len(embeddings))]
+
+    queries = embeddings[rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)]
+    queries = queries + rng.standard_normal(queries.shape, dtype=np.float32) * queries.std() * 0.5
+
+    return ids, embeddings, queries
+
+def exact_neighbours(embeddings, queries, k):
+
+    from vector_math import squared_l2, top_k
+
+    return [top_k(distances, k) for distances in squared_l2(queries, embeddings)]
+
+def recall(found, expected):
+    return len(set(found) & set(expected)) / max(len(expected), 1)
+
+def add_embeddings_arguments(parser):
+    parser.add_argument('--collection', help="use the vectors of this collection instead of synthetic ones")
+    parser.add_argument('--questions', help="file with one question per line, used as queries for --collection")
+    parser.add_argument('--vectors', type=int, default=50000, help="amount of synthetic vectors")
+    parser.add_argument('--dim', type=int, default=512, help="dimension of synthetic vectors")
+    parser.add_argument('--queries', type=int, default=200, help="amount of queries sampled from the vectors")
+    parser.add_argument('-k', type=int, default=5)
+
+def report(rows, columns):
+
+    widths = [max(len(str(column)), *(len(str(row[i])) for row in rows)) for i, column in enumerate(columns)]
+
+    print(' | '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    print('-+-'.join('-' * width for width in widths))
+
+    for row in rows:
+        print(' | '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+## Benchmarks
+def benchmark_embedding(args):
+
+    from EmbeddingService import EmbeddingService, MIN_POOL_SENTENCES
+
+    sentences = load_sentences(args)
+
+    rows = []
+
+    for workers in parse_list(args.workers):
+        for threads in parse_list(args.threads):
+            for batch_size in parse_list(args.batch_sizes):
+
+                service = EmbeddingService(args.model, batch_size=batch_size, threads=threads, workers=workers)
+
+                # Warm up, so model loading and worker start up are not measured
+                service.encode(sentences[:max(batch_size * max(workers, 1), MIN_POOL_SENTENCES)])
+
+                start = time.time()
+                service.encode(sentences)
+                elapsed = time.time() - start
+
+                service.close()
+
+                rows.append((workers, threads, batch_size, f"{elapsed:.2f}", f"{len(sentences) / elapsed:.1f}"))
+
+                print(f"workers={workers} threads={threads} batch_size={batch_size}: {len(sentences) / elapsed:.1f} sentences/s")
+
+    report(rows, ('workers', 'threads', 'batch_size', 'seconds', 'sentences/s'))
+
+def benchmark_onnx(args):
+
+    import numpy as np
+    from EmbeddingService import EmbeddingService
+
+    sentences = load_sentences(args)
+    questions = synthetic_sentences(args.queries, min_words=3, max_words=12, seed=1)
+
+    rows = []
+    reference = None
+
+    # torch first, it is the reference for the parity of the other backends
+    for backend, quantize in (('torch', False), ('onnx', False), ('onnx', True)):
+
+        start = time.time()
+        service = EmbeddingService(args.model, batch_size=args.batch_size, threads=args.threads, backend=backend, quantize=quantize)
+        service.warm_up()
+        load_s = time.time() - start
+
+        latencies = []
+        for question in questions:
+            start = time.time()
+            service.encode([question])
+            latencies.append((time.time() - start) * 1000)
+
+        start = time.time()
+        embeddings = service.encode(sentences)
+        throughput = len(sentences) / (time.time() - start)
+
+        if reference is None:
+            reference = embeddings
+
+        # Agreement with the original model, per sentence and in the neighbours each one finds among the others
+        cosines = np.einsum('ij,ij->i', embeddings, reference) / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(reference, axis=1))
+
+        queries = embeddings[:args.queries]
+        found = exact_neighbours(embeddings, queries, args.k)
+        expected = exact_neighbours(reference, reference[:args.queries], args.k)
+
+        neighbours_recall = np.mean([recall(f, e) for f, e in zip(found, expected)])
+
+        rows.append((
+            f"{backend}{' int8' if quantize else ''}",
+            f"{load_s:.1f}",
+            f"{np.percentile(latencies, 50):.1f}",
+            f"{np.percentile(latencies, 95):.1f}",
+            f"{throughput:.1f}",
+            f"{cosines.mean():.4f}",
+            f"{cosines.min():.4f}",
+            f"{neighbours_recall:.3f}"
+        ))
+
+        print(f"{rows[-1][0]}: {throughput:.1f} sentences/s, cosine {cosines.mean():.4f}")
+
+    report(rows, ('backend', 'load s', 'p50 ms/query', 'p95 ms/query', 'sentences/s', 'mean cosine', 'min cosine', f'recall@{args.k}'))
+
+def benchmark_prefix(args):
+
+    import numpy as np
+    from LLM import INST_PROMPT_PREFIX, INST_PROMPT_TEMPLATE
+    from ModelManager import get_model_manager
+
+    manager = get_model_manager()
+    client = manager.get(args.model).client
+
+    contexts = synthetic_sentences(args.runs, min_words=args.context_words, max_words=args.context_words, seed=2)
+    questions = synthetic_sentences(args.runs, min_words=5, max_words=12, seed=3)
+
+    prompts = [
+        INST_PROMPT_TEMPLATE.format(default_answer="Não encontrei a resposta para sua pergunta.", context=context, references="[1] https://www.pucpr.br", question=question)
+        for context, question in zip(contexts, questions)
+    ]
+
+    rows = []
+
+    # cold evaluates every prompt from scratch, cached restores the state after the static prefix
+    for mode in ('cold', 'cached'):
+
+        latencies = []
+
+        for prompt in prompts:
+
+            if mode == 'cold':
+                client.reset()
+
+            start = time.time()
+
+            tokens = manager.stream(args.model, prompt, 0.7, 0.95, 1, prefix=INST_PROMPT_PREFIX if mode == 'cached' else None)
+            next(tokens, None)
+
+            latencies.append((time.time() - start) * 1000)
+
+            tokens.close()
+
+        rows.append((mode, len(prompts), f"{np.percentile(latencies, 50):.0f}", f"{np.percentile(latencies, 95):.0f}"))
+
+    report(rows, ('prompt', 'runs', 'p50 ms to first token', 'p95 ms to first token'))
+
+def benchmark_compact(args):
+
+    import numpy as np
+    from CompactIndex import CompactIndex
+
+    ids, embeddings, queries = load_embeddings(args)
+
+    expected = exact_neighbours(embeddings, queries, args.k)
+
+    # Full precision search, the baseline for latency
+    start = time.time()
+    exact_neighbours(embeddings, queries, args.k)
+    exact_ms = (time.time() - start) * 1000 / len(queries)
+
+    rows = [('float32', embeddings.shape[1], f"{embeddings.nbytes / 2**20:.1f}", '1.0x', '1.000', '1.000', f"{exact_ms:.2f}")]
+
+    positions = {id : i for i, id in enumerate(ids)}
+    fetch_full = lambda found: embeddings[[positions[id] for id in found]]
+
+    for dtype in args.dtypes.split(','):
+        for dims in parse_list(args.dims):
+
+            index = CompactIndex.fit(ids, embeddings, dtype=dtype, dims=dims)
+
+            approximate_recall, rescored_recall = [], []
+
+            start = time.time()
+            for query, neighbours in zip(queries, expected):
+                found, _ = index.search(query, args.k, fetch_full=fetch_full)
+                rescored_recall.append(recall(found, [ids[i] for i in neighbours]))
+            search_ms = (time.time() - start) * 1000 / len(queries)
+
+            for query, neighbours in zip(queries, expected):
+                found, _ = index.search(query, args.k)
+                approximate_recall.append(recall(found, [ids[i] for i in neighbours]))
+
+            rows.append((
+                dtype,
+                dims or embeddings.shape[1],
+                f"{index.nbytes / 2**20:.1f}",
+                f"{embeddings.nbytes / index.nbytes:.1f}x",
+                f"{np.mean(approximate_recall):.3f}",
+                f"{np.mean(rescored_recall):.3f}",
+                f"{search_ms:.2f}"
+            ))
+
+    report(rows, ('dtype', 'dims', 'MB', 'smaller', f'recall@{args.k}', f'recall@{args.k} rescored', 'ms/query'))
+
+def benchmark_hierarchical(args):
+
+    import numpy as np
+    from PageIndex import PageIndex
+
+    rng = np.random.default_rng(0)
+
+    if args.collection:
+        from DB import DB, CHROMA_ID, CHROMA_EMBEDDINGS
+
+        db = DB()
+        collection = db.get_collection(args.collection)
+
+        ids, embeddings = [], []
+        for batch in db.iterate_collection(collection, [CHROMA_EMBEDDINGS]):
+            ids.extend(batch[CHROMA_ID])
+            embeddings.extend(batch[CHROMA_EMBEDDINGS])
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        references = db.references.chunk_pages(args.collection)
+
+        print(f"Loaded {len(ids)} vectors and {len(references)} references from {args.collection}")
+    else:
+        # Chunks of the same page are close to each other, like the sections of a real page
+        centers = rng.standard_normal((args.pages, args.dim), dtype=np.float32)
+        embeddings = np.repeat(centers, args.chunks_per_page, axis=0) + rng.standard_normal((args.pages * args.chunks_per_page, args.dim), dtype=np.float32) * args.spread
+        ids = [str(i) for i in range(len(embeddings))]
+        references = [(id, f"page{i // args.chunks_per_page}") for i, id in enumerate(ids)]
+
+    queries = embeddings[rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)]
+    queries = queries + rng.standard_normal(queries.shape, dtype=np.float32) * queries.std() * 0.5
+
+    expected = exact_neighbours(embeddings, queries, args.k)
+
+    # One query at a time, as they arrive when answering questions
+    start = time.time()
+    for query in queries:
+        exact_neighbours(embeddings, query[None, :], args.k)
+    flat_ms = (time.time() - start) * 1000 / len(queries)
+
+    rows = [('flat', len(ids), '1.000', f"{flat_ms:.2f}")]
+
+    start = time.time()
+    index = PageIndex.build(ids, embeddings, references)
+    print(f"Page index built in {time.time() - start:.2f}s: {len(index)} pages, {index.chunks_per_page:.1f} chunks per page")
+
+    for pages in parse_list(args.candidates):
+
+        found_recall = []
+
+        start = time.time()
+        for query, neighbours in zip(queries, expected):
+            found, _ = index.search(query, args.k, pages=pages)
+            found_recall.append(recall(found, [ids[i] for i in neighbours]))
+        search_ms = (time.time() - start) * 1000 / len(queries)
+
+        rows.append((f"{pages} pages", min(int(pages * index.chunks_per_page), len(ids)), f"{np.mean(found_recall):.3f}", f"{search_ms:.2f}"))
+
+    report(rows, ('search', '~chunks scored', f'recall@{args.k}', 'ms/query'))
+
+def benchmark_hnsw(args):
+
+    import shutil
+    import tempfile
+    import numpy as np
+    from VectorStore import ChromaStore, hnsw_metadata
+    from vector_math import space_distances, top_k
+
+    # Use --questions with --collection for a held-out question set, otherwise noisy copies of stored vectors are the queries
+    ids, embeddings, queries = load_embeddings(args)
+
+    rows = []
+
+    for space in args.spaces.split(','):
+
+        # Exact neighbours in the same space the collection searches
+        expected = [top_k(distances, args.k) for distances in space_distances(queries, embeddings, space)]
+
+        for M in parse_list(args.M):
+            for construction_ef in parse_list(args.construction_ef):
+                for search_ef in parse_list(args.search_ef):
+
+                    path = tempfile.mkdtemp(prefix="benchmark_hnsw_")
+
+                    try:
+                        collection = ChromaStore(path).create_collection('tuning', metadata=hnsw_metadata(space, M, construction_ef, search_ef))
+
+                        start = time.time()
+                        for i in range(0, len(ids), args.batch_size):
+                            collection.upsert(ids=ids[i:i + args.batch_size], embeddings=embeddings[i:i + args.batch_size].tolist())
+                        build_s = time.time() - start
+
+                        # First query loads the index
+                        collection.query(query_embeddings=[queries[0].tolist()], n_results=args.k, include=[])
+
+                        latencies, found_recall, kth_distances = [], [], []
+
+                        for query, neighbours in zip(queries, expected):
+                            start = time.time()
+                            result = collection.query(query_embeddings=[query.tolist()], n_results=args.k, include=['distances'])
+                            latencies.append((time.time() - start) * 1000)
+
+                            found_recall.append(recall(result['ids'][0], [ids[i] for i in neighbours]))
+                            kth_distances.append(result['distances'][0][-1])
+
+                        rows.append((
+                            space,
+                            M,
+                            construction_ef,
+                            search_ef,
+                            f"{build_s:.1f}",
+                            f"{np.mean(found_recall):.3f}",
+                            f"{np.percentile(latencies, 50):.2f}",
+                            f"{np.percentile(latencies, 95):.2f}",
+                            # Typical distance of the k-th result, a starting point for the distance threshold of the LLM settings
+                            f"{np.median(kth_distances):.3f}"
+                        ))
+
+                        print(f"space={space} M={M} construction_ef={construction_ef} search_ef={search_ef}: recall@{args.k} {np.mean(found_recall):.3f}")
+
+                    finally:
+                        shutil.rmtree(path, ignore_errors=True)
+
+    report(rows, ('space', 'M', 'construction_ef', 'search_ef', 'build s', f'recall@{args.k}', 'p50 ms/query', 'p95 ms/query', f'median distance@{args.k}'))
+
+def benchmark_bm25(args):
+
+    from BM25Index import BM25Index
+
+    documents = load_sentences(args)
+    ids = [str(i) for i in range(len(documents))]
+
+    start = time.time()
+    index = BM25Index.build(ids, documents)
+    build_s = time.time() - start
+
+    if args.questions:
+        with open(args.questions, 'r', encoding='utf8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    else:
+        questions = synthetic_sentences(args.queries, min_words=3, max_words=12, seed=1)
+
+    start = time.time()
+    for question in questions:
+        index.search(question, args.k)
+    search_ms = (time.time() - start) * 1000 / len(questions)
+
+    report([(len(index), len(index.vocabulary), f"{build_s:.2f}", f"{search_ms:.3f}")], ('documents', 'terms', 'build s', 'ms/query'))
+
+def benchmark_store(args):
+
+    import shutil
+    import tempfile
+    import numpy as np
+    from VectorStore import create_store
+
+    rng = np.random.default_rng(0)
+
+    embeddings = rng.standard_normal((args.vectors, args.dim), dtype=np.float32)
+    ids = [str(i) for i in range(len(embeddings))]
+    documents = [f"document {i}" for i in ids]
+    metadatas = [{'position' : i} for i in range(len(ids))]
+
+    queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+
+    rows = []
+
+    for backend in args.backends.split(','):
+
+        path = tempfile.mkdtemp(prefix=f"benchmark_{backend}_")
+
+        try:
+            store = create_store(backend, path)
+            collection = store.create_collection('benchmark')
+
+            start = time.time()
+            for i in range(0, len(ids), args.batch_size):
+                collection.upsert(ids=ids[i:i + args.batch_size], documents=documents[i:i + args.batch_size], metadatas=metadatas[i:i + args.batch_size], embeddings=embeddings[i:i + args.batch_size].tolist())
+            ingest_s = time.time() - start
+
+            # First query loads the index
+            collection.query(query_embeddings=[queries[0].tolist()], n_results=args.k)
+
+            latencies = []
+            for query in queries:
+                start = time.time()
+                collection.query(query_embeddings=[query.tolist()], n_results=args.k)
+                latencies.append((time.time() - start) * 1000)
+
+            rows.append((
+                backend,
+                len(ids),
+                f"{len(ids) / ingest_s:.0f}",
+                f"{np.percentile(latencies, 50):.2f}",
+                f"{np.percentile(latencies, 95):.2f}"
+            ))
+
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    report(rows, ('store', 'vectors', 'ingest vectors/s', 'p50 ms/query', 'p95 ms/query'))
+
+def main():
+
+    from DB import MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the knowledge-chat storage and retrieval components")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    embedding = subparsers.add_parser('embedding', help="sentences/s of the embedding service for different settings")
+    embedding.add_argument('--model', default=MODEL_NAME)
+    embedding.add_argument('--collection', help="use the documents of this collection instead of synthetic sentences")
+    embedding.add_argument('--sentences', type=int, default=2000)
+    embedding.add_argument('--batch-sizes', default='16,32,64,128')
+    embedding.add_argument('--threads', default='0', help="torch threads per process, 0 keeps the torch default")
+    embedding.add_argument('--workers', default='0', help="worker processes, 0 encodes in the current process")
+    embedding.set_defaults(run=benchmark_embedding)
+
+    onnx = subparsers.add_parser('onnx', help="parity, latency and throughput of the ONNX Runtime backends against torch")
+    onnx.add_argument('--model', default=MODEL_NAME)
+    onnx.add_argument('--collection', help="use the documents of this collection instead of synthetic sentences")
+    onnx.add_argument('--sentences', type=int, default=2000)
+    onnx.add_argument('--queries', type=int, default=200, help="amount of single question encodes timed")
+    onnx.add_argument('--batch-size', type=int, default=64)
+    onnx.add_argument('--threads', type=int, default=0, help="threads of each backend, 0 keeps their default")
+    onnx.add_argument('-k', type=int, default=5)
+    onnx.set_defaults(run=benchmark_onnx)
+
+    prefix = subparsers.add_parser('prefix', help="time to first token with and without the cached state of the static prompt prefix")
+    prefix.add_argument('--model', default='llama2')
+    prefix.add_argument('--runs', type=int, default=10)
+    prefix.add_argument('--context-words', type=int, default=200, help="words of the synthetic context of each prompt")
+    prefix.set_defaults(run=benchmark_prefix)
+
+    compact = subparsers.add_parser('compact', help="memory, recall and latency of compact vectors against full precision")
+    add_embeddings_arguments(compact)
+    compact.add_argument('--dtypes', default='float16,int8')
+    compact.add_argument('--dims', default='0,256,128,64', help="dimensions kept by PCA, 0 keeps all of them")
+    compact.set_defaults(run=benchmark_compact)
+
+    hierarchical = subparsers.add_parser('hierarchical', help="recall and latency of the two-stage page index against flat search")
+    hierarchical.add_argument('--collection', help="use the vectors and references of this collection instead of synthetic pages")
+    hierarchical.add_argument('--pages', type=int, default=5000, help="amount of synthetic pages")
+    hierarchical.add_argument('--chunks-per-page', type=int, default=10)
+    hierarchical.add_argument('--spread', type=float, default=0.5, help="noise of synthetic chunks around the center of their page")
+    hierarchical.add_argument('--dim', type=int, default=512)
+    hierarchical.add_argument('--queries', type=int, default=200)
+    hierarchical.add_argument('--candidates', default='5,10,20,50', help="pages selected by the first stage")
+    hierarchical.add_argument('-k', type=int, default=5)
+    hierarchical.set_defaults(run=benchmark_hierarchical)
+
+    hnsw = subparsers.add_parser('hnsw', help="recall, latency and build time of ChromaDB HNSW settings against exact search")
+    add_embeddings_arguments(hnsw)
+    hnsw.add_argument('--spaces', default='l2', help="distance spaces: l2, ip, cosine")
+    hnsw.add_argument('--M', default='8,16,32')
+    hnsw.add_argument('--construction-ef', default='100,200')
+    hnsw.add_argument('--search-ef', default='10,50,100')
+    hnsw.add_argument('--batch-size', type=int, default=1000)
+    hnsw.set_defaults(run=benchmark_hnsw)
+
+    bm25 = subparsers.add_parser('bm25', help="build time and query latency of the BM25 index")
+    bm25.add_argument('--collection', help="use the documents of this collection instead of synthetic sentences")
+    bm25.add_argument('--sentences', type=int, default=50000, help="amount of documents")
+    bm25.add_argument('--questions', help="file with one question per line")
+    bm25.add_argument('--queries', type=int, default=1000, help="amount of synthetic questions")
+    bm25.add_argument('-k', type=int, default=5)
+    bm25.set_defaults(run=benchmark_bm25)
+
+    store = subparsers.add_parser('store', help="ingest throughput and query latency of each vector store")
+    store.add_argument('--backends', default='chroma,numpy')
+    store.add_argument('--vectors', type=int, default=50000)
+    store.add_argument('--dim', type=int, default=512)
+    store.add_argument('--queries', type=int, default=200)
+    store.add_argument('--batch-size', type=int, default=1000)
+    store.add_argument('-k', type=int, default=5)
+    store.set_defaults(run=benchmark_store)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
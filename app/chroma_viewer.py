@@ -1,21 +1,26 @@
-import chromadb
 import os
 from dotenv import load_dotenv
 
 import pandas as pd 
 import streamlit as st
 
+from VectorStore import create_store
+from ReferenceTable import ReferenceTable, REFERENCES_FILE
+
 #Fixed names from chromadb
 CHROMA_ID = "ids"
 CHROMA_DOCS = "documents"
 CHROMA_METADATA = "metadatas"
 
-def setup_client(dir):
-    return chromadb.PersistentClient(path=dir)
+# Column with the URLs of each chunk, from the reference table
+REFERENCES_COLUMN = "urls"
+
+def setup_client(dir, backend):
+    return create_store(backend, dir)
 
 def collection_names(client):
     print(f"collections list: {client.list_collections()}")
-    return sorted([collection.name for collection in client.list_collections()])
+    return sorted(client.list_collections())
 
 def setup_selection(available_connections):
 
@@ -26,30 +31,32 @@ def setup_selection(available_connections):
 
 def open_metadata(metadata):
 
-    metadata_keys = list(metadata[0].keys()) # Get keys from the first metadata dict
+    metadata_keys = list(dict.fromkeys(key for d in metadata for key in (d or {}))) # Get keys from every metadata dict, older chunks may have different keys
 
     out_dict = {}
 
     for key in metadata_keys:
-        out_dict[key] = [d[key] for d in metadata]  # Extract values for each key
+        out_dict[key] = [(d or {}).get(key) for d in metadata]  # Extract values for each key
 
     return out_dict
 
-def format_data(data):
+def format_data(data, references):
 
     formatted = {CHROMA_ID : data[CHROMA_ID]}
 
     formatted.update(open_metadata(data[CHROMA_METADATA]))
 
+    formatted[REFERENCES_COLUMN] = [' , '.join(url for url, _ in references.get(id, [])) for id in data[CHROMA_ID]]
+
     formatted.update({CHROMA_DOCS : data[CHROMA_DOCS]})
 
     return formatted
 
-def view_data(data):
+def view_data(data, references):
 
     if data[list(data)[0]]: # Checking if there is content within the data
 
-        display_data = format_data(data)
+        display_data = format_data(data, references)
 
         df = pd.DataFrame.from_dict(display_data)
         st.dataframe(df)
@@ -67,6 +74,10 @@ def run():
     except Exception as e:
         db_path = "chromaDB"
 
+    backend = os.getenv('VECTOR_STORE', 'chroma')
+
+    references = ReferenceTable(os.path.join(os.getenv('PATH_INDEXES', 'indexes'), REFERENCES_FILE))
+
     full_path = os.path.join(db_path) 
     
     if not os.path.exists(full_path):
@@ -75,7 +86,7 @@ def run():
     if os.path.exists(full_path):
 
         print(f'Starting client from {full_path}')
-        client = setup_client(full_path)
+        client = setup_client(full_path, backend)
 
         available_connections = collection_names(client)
 
@@ -89,11 +100,14 @@ def run():
 
             collection = client.get_collection(name=chosen_collection) #reading from selectbox variable will return it's text
 
-            view_data(data=collection.get())
+            data = collection.get()
+
+            view_data(data=data, references=references.resolve(chosen_collection, data[CHROMA_ID]))
 
             # Remove Collection button
             if st.button("Remover Coleção"):
                 client.delete_collection(name=chosen_collection)
+                references.delete_collection(chosen_collection)
 
         else:
 
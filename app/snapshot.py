@@ -0,0 +1,248 @@
+import os
+import gzip
+import json
+import time
+import base64
+import hashlib
+import argparse
+from itertools import islice
+
+import numpy as np
+
+from DB import DB, batched, BATCH_SIZE, CHROMA_ID, CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_EMBEDDINGS
+from exceptions import BaseError
+from logger_config import configure_logger
+
+SNAPSHOT_FORMAT = 'knowledge-chat-snapshot'
+# Version 2 covers the header with the checksum and counts records only in the footer
+SNAPSHOT_VERSION = 2
+
+logger = configure_logger('SN', 'debug', 'logs')
+
+## A snapshot is a gzip compressed JSON lines file:
+# header : {format, version, collection, model, dimension, metadata, created}
+# records : {id, document, metadata, embedding (base64 of little-endian float32), references [[url, section]]}
+# footer : {footer, count, sha256 (of the header and record lines)}
+
+class SnapshotError(BaseError):
+    pass
+
+# Same as DB.batched, for iterables that can't be sliced, like the lines of a file being read
+def stream_batches(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+def encode_vector(vector):
+    return base64.b64encode(np.asarray(vector, dtype='<f4').tobytes()).decode('ascii')
+
+def decode_vector(text):
+    return np.frombuffer(base64.b64decode(text), dtype='<f4')
+
+def export_snapshot(db, collection_name, path, batch_size=BATCH_SIZE):
+
+    """
+    Writes every chunk of the collection to a snapshot at path, returns the amount of chunks written
+    """
+
+    start = time.time()
+
+    collection = db.get_collection(collection_name)
+
+    # IDs are listed first and fetched later, chunks are immutable (their ID comes from their content), so the snapshot
+    # has exactly the chunks stored when it started, except the ones deleted meanwhile
+    ids = []
+    for batch in db.iterate_collection(collection, [], batch_size):
+        ids.extend(batch[CHROMA_ID])
+
+    digest = hashlib.sha256()
+    count = 0
+
+    # Written to a temporary file and renamed at the end, so a snapshot at path is always complete
+    tmp_path = f"{path}.tmp"
+
+    with gzip.open(tmp_path, 'wt', encoding='utf8') as f:
+
+        # The amount of records is only known at the end, chunks deleted while exporting are skipped, so it's in the footer
+        header = json.dumps({
+            'format' : SNAPSHOT_FORMAT,
+            'version' : SNAPSHOT_VERSION,
+            'collection' : collection_name,
+            'model' : db.ef.embedding_name,
+            'dimension' : db.ef.model.get_sentence_embedding_dimension(),
+            # HNSW settings, the imported collection is created with the same ones
+            'metadata' : collection.metadata,
+            'created' : time.time()
+        }) + '\n'
+
+        digest.update(header.encode('utf8'))
+        f.write(header)
+
+        for batch_ids in batched(ids, batch_size):
+
+            batch = collection.get(ids=batch_ids, include=[CHROMA_DOCUMENTS, CHROMA_METADATA, CHROMA_EMBEDDINGS])
+            references = db.resolve_references(collection_name, batch[CHROMA_ID])
+
+            for id, document, metadata, embedding in zip(batch[CHROMA_ID], batch[CHROMA_DOCUMENTS], batch[CHROMA_METADATA], batch[CHROMA_EMBEDDINGS]):
+
+                line = json.dumps({
+                    'id' : id,
+                    'document' : document,
+                    'metadata' : metadata,
+                    'embedding' : encode_vector(embedding),
+                    'references' : references.get(id, [])
+                }, ensure_ascii=False) + '\n'
+
+                digest.update(line.encode('utf8'))
+                f.write(line)
+                count += 1
+
+        f.write(json.dumps({'footer' : True, 'count' : count, 'sha256' : digest.hexdigest()}) + '\n')
+
+    os.replace(tmp_path, path)
+
+    logger.info(f"Exported {count} chunks of {collection_name} to {path} ({os.path.getsize(path) / 2**20:.1f} MB) in {time.time() - start:.2f}s")
+
+    return count
+
+def read_snapshot(path):
+
+    """
+    Yields the header and its line, then each record line, then the footer, reading the file as a stream
+    """
+
+    with gzip.open(path, 'rt', encoding='utf8') as f:
+
+        header_line = f.readline()
+        header = json.loads(header_line or 'null')
+
+        if not header or header.get('format') != SNAPSHOT_FORMAT:
+            raise SnapshotError(f"{path} is not a knowledge-chat snapshot")
+
+        if header['version'] > SNAPSHOT_VERSION:
+            raise SnapshotError(f"Snapshot version {header['version']} is newer than the supported version {SNAPSHOT_VERSION}")
+
+        yield header, header_line
+
+        for line in f:
+            yield line
+
+def verify_snapshot(path):
+
+    """
+    Checks the checksum and amount of records of the snapshot without loading it, returns its header with the amount of records
+    """
+
+    digest = hashlib.sha256()
+    count = 0
+    footer = None
+
+    lines = read_snapshot(path)
+    header, header_line = next(lines)
+
+    # Version 1 snapshots only covered the records
+    if header['version'] >= 2:
+        digest.update(header_line.encode('utf8'))
+
+    for line in lines:
+
+        if footer is not None:
+            raise SnapshotError(f"{path} has data after its footer")
+
+        if line.startswith('{"footer"'):
+            footer = json.loads(line)
+            continue
+
+        digest.update(line.encode('utf8'))
+        count += 1
+
+    if footer is None:
+        raise SnapshotError(f"{path} is truncated, it has no footer")
+
+    if footer['sha256'] != digest.hexdigest() or footer['count'] != count:
+        raise SnapshotError(f"{path} is corrupted, checksum or amount of records doesn't match")
+
+    return {**header, 'count' : count}
+
+def import_snapshot(db, path, collection_name=None, batch_size=BATCH_SIZE):
+
+    """
+    Loads a snapshot into the collection (the snapshot one by default) without embedding anything again.
+    The snapshot is verified first, and only batch_size records are held in memory while loading
+    """
+
+    start = time.time()
+
+    header = verify_snapshot(path)
+
+    # Vectors of another model would be compared against questions embedded by this one
+    if header['model'] != db.ef.embedding_name:
+        raise SnapshotError(f"Snapshot was embedded with {header['model']}, but this node uses {db.ef.embedding_name}")
+
+    collection_name = collection_name or header['collection']
+    collection = db.create_collection(collection_name, header.get('metadata'))
+
+    lines = read_snapshot(path)
+    next(lines)
+
+    records = (json.loads(line) for line in lines if not line.startswith('{"footer"'))
+
+    count = 0
+
+    for batch in stream_batches(records, batch_size):
+
+        ids = [record['id'] for record in batch]
+        embeddings = [decode_vector(record['embedding']) for record in batch]
+
+        collection.upsert(
+            ids=ids,
+            documents=[record['document'] for record in batch],
+            metadatas=[record['metadata'] for record in batch],
+            embeddings=[embedding.tolist() for embedding in embeddings]
+        )
+
+        db.references.add(collection_name, [(record['id'], url, section) for record in batch for url, section in record['references']])
+
+        # Chunks scraped later by this node are found in the cache instead of embedded
+        if db.cache is not None:
+            db.cache.store(ids, embeddings)
+
+        count += len(batch)
+
+        logger.debug(f"Imported {count}/{header['count']} chunks")
+
+    # Indexes are rebuilt when the collection is next searched
+    db.references.bump_version(collection_name)
+
+    logger.info(f"Imported {count} chunks from {path} into {collection_name} in {time.time() - start:.2f}s")
+
+    return count
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Exports and imports snapshots of knowledge-chat collections")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help="writes a snapshot of a collection")
+    export.add_argument('collection')
+    export.add_argument('path', help="snapshot file, e.g. collection.jsonl.gz")
+
+    load = subparsers.add_parser('import', help="loads a snapshot into a collection")
+    load.add_argument('path')
+    load.add_argument('--collection', help="collection to load into, the snapshot one by default")
+
+    verify = subparsers.add_parser('verify', help="checks the integrity of a snapshot")
+    verify.add_argument('path')
+
+    args = parser.parse_args()
+
+    match args.command:
+        case 'export':
+            export_snapshot(DB(), args.collection, args.path)
+        case 'import':
+            import_snapshot(DB(), args.path, args.collection)
+        case 'verify':
+            print(verify_snapshot(args.path))
+
+if __name__ == '__main__':
+    main()
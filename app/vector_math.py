@@ -0,0 +1,121 @@
+import numpy as np
+
+# Squared euclidean distance between each query and each row of matrix, the same distance ChromaDB uses by default (l2)
+def squared_l2(queries, matrix, matrix_norms=None):
+
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+
+    if matrix_norms is None:
+        matrix_norms = np.einsum('ij,ij->i', matrix, matrix)
+
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+
+    # ||q - x||² = ||q||² + ||x||² - 2 q·x, so all distances come from a single matrix product
+    distances = query_norms[:, None] + matrix_norms[None, :] - 2 * (queries @ matrix.T)
+
+    # Rounding errors can make distances of identical vectors slightly negative
+    return np.maximum(distances, 0)
+
+# Distances in the space of a collection, the same ChromaDB computes: squared l2, 1 - inner product or 1 - cosine similarity
+def space_distances(queries, matrix, space='l2', matrix_norms=None):
+
+    if space == 'l2':
+        return squared_l2(queries, matrix, matrix_norms)
+
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+
+    products = queries @ matrix.T
+
+    if space == 'ip':
+        return 1 - products
+
+    if space == 'cosine':
+
+        if matrix_norms is None:
+            matrix_norms = np.einsum('ij,ij->i', matrix, matrix)
+
+        # matrix_norms are squared, the same ones squared_l2 receives
+        lengths = np.sqrt(np.einsum('ij,ij->i', queries, queries))[:, None] * np.sqrt(matrix_norms)[None, :]
+
+        return 1 - products / np.maximum(lengths, 1e-12)
+
+    raise ValueError(f"Distance space {space} not available, use 'l2', 'ip' or 'cosine'")
+
+# Positions of the k smallest values of a 1d array, sorted from the smallest
+def top_k(distances, k):
+
+    k = min(k, len(distances))
+
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+
+    # argpartition only orders the k smallest values, instead of sorting the whole array
+    positions = np.argpartition(distances, k - 1)[:k]
+
+    return positions[np.argsort(distances[positions], kind='stable')]
+
+# Rows scaled to unit length, so their products are cosine similarities
+def normalize_rows(matrix):
+
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+# Positions of the rows kept, in order, when every row with a cosine similarity of at least threshold to an earlier kept row is dropped
+def collapse_duplicates(matrix, threshold):
+
+    vectors = normalize_rows(matrix)
+
+    # Every pair compared with a single matrix product
+    similarities = vectors @ vectors.T
+
+    keep = np.ones(len(vectors), dtype=bool)
+
+    for i in range(len(vectors)):
+        # Only kept rows remove the rows after them
+        if keep[i]:
+            keep[i + 1:] &= similarities[i, i + 1:] < threshold
+
+    return np.flatnonzero(keep)
+
+# Maximal marginal relevance: positions of k rows, each the most relevant after discounting its similarity to the rows already chosen.
+# relevance is the score of each row between 0 and 1, like a cosine similarity. weight 1 ranks by relevance only, 0 by diversity only
+def maximal_marginal_relevance(relevance, matrix, k, weight=0.7):
+
+    vectors = normalize_rows(matrix)
+
+    relevance = np.asarray(relevance, dtype=np.float32)
+    similarities = vectors @ vectors.T
+
+    # Highest similarity of each row to the chosen ones, -1 is the lowest cosine similarity
+    redundancy = np.full(len(vectors), -1.0, dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+
+    selected = []
+
+    for _ in range(min(k, len(vectors))):
+
+        scores = np.where(available, weight * relevance - (1 - weight) * redundancy, -np.inf)
+
+        chosen = int(np.argmax(scores))
+
+        selected.append(chosen)
+        available[chosen] = False
+        redundancy = np.maximum(redundancy, similarities[chosen])
+
+    return np.array(selected, dtype=np.int64)
+
+# Relevance of the rows of a ranking, best first, from 1 for the first down to 1 / n for the last
+def rank_relevance(n):
+    return 1 - np.arange(n, dtype=np.float32) / max(n, 1)
+
+# Reciprocal rank fusion of several rankings of ids, best first. Each id scores 1 / (k + rank) in every ranking it appears
+def reciprocal_rank_fusion(rankings, k=60):
+
+    scores = {}
+
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0) + 1 / (k + rank)
+
+    return sorted(scores, key=scores.get, reverse=True)